@@ -1,33 +1,54 @@
-from sys import argv
+import argparse
+
+from parser import lex_chunks
+from instructions import read_instructions
+from compile_ctx import StreamingCompileCtx
+from incremental import SectionCache, assemble_incremental
+
+# Characters read from the source at a time
+CHUNK_SIZE = 1 << 16
+
+def read_chunks(f, size=CHUNK_SIZE):
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+# Assembles the source file inf into the seekable binary file out, a chunk
+# at a time. Gives the size of the output
+def assemble(inf, out, chunk_size=CHUNK_SIZE):
+    compile_ctx = StreamingCompileCtx(out)
+    for inst in read_instructions(lex_chunks(read_chunks(inf, chunk_size))):
+        inst.compile_to_bytes(compile_ctx)
+        compile_ctx.flush()
 
-from parser import tokenize, cleanup
-from instructions import read_instlist
-from compile_ctx import CompileCtx
+    return compile_ctx.finish()
 
-if __name__ == "__main__":
-    if len(argv) == 2:
-        inpath = argv[1]
-        outpath = "a.out"
-    elif len(argv) == 3:
-        inpath = argv[1]
-        outpath = argv[2]
-    else:
-        print("python3 assembler.py <input> [output]")
-        exit()
-
-    with open(inpath, "r") as f:
-        content = f.read()
-
-    tokens = tokenize(content)
-    tokens = cleanup(tokens)
-
-    instlist = read_instlist(tokens)
-
-    compile_ctx = CompileCtx()
-    for inst in instlist:
-        inst.compile_to_bytes(compile_ctx)
+# Assembles the file at inpath into outpath. With a cache directory, only
+# the sections that aren't in it are assembled, unless the source needs a
+# full build to be assembled the same way
+def assemble_file(inpath, outpath, cache_dir=None):
+    if cache_dir is not None:
+        with open(inpath, "r") as f:
+            content = f.read()
 
-    result = compile_ctx.postproc()
+        cache = SectionCache(cache_dir)
+        result = assemble_incremental(content, cache)
+        if result is not None:
+            print(f"Re-assembled {cache.misses} of {cache.hits + cache.misses} sections")
+            with open(outpath, "wb") as out:
+                out.write(result)
+            return
+
+    with open(inpath, "r") as inf, open(outpath, "wb") as out:
+        assemble(inf, out)
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Assemble a human-cpu program")
+    argparser.add_argument("input")
+    argparser.add_argument("output", nargs="?", default="a.out")
+    argparser.add_argument("--cache", metavar="DIR", help="only re-assemble the sections that changed since they were cached here")
+    args = argparser.parse_args()
 
-    with open(outpath, "wb") as out:
-        out.write(result)
+    assemble_file(args.input, args.output, args.cache)
@@ -1,20 +1,44 @@
+import ast
 import struct
 import simpleeval
 
+# Parsed expressions by their source text, shared between all contexts as
+# the same expressions (mostly just label names) show up over and over
+PARSED_EXPRS = {}
+
+def parse_expr(expr):
+    parsed = PARSED_EXPRS.get(expr)
+    if parsed is None:
+        parsed = PARSED_EXPRS[expr] = simpleeval.SimpleEval.parse(expr)
+    return parsed
+
+# Names used in the expression, by its source text
+EXPR_NAMES = {}
+
+def expr_names(expr):
+    names = EXPR_NAMES.get(expr)
+    if names is None:
+        names = EXPR_NAMES[expr] = {node.id for node in ast.walk(parse_expr(expr)) if isinstance(node, ast.Name)}
+    return names
+
+# Bytes a StreamingCompileCtx keeps before writing them out
+FLUSH_SIZE = 1 << 16
 
 class CompileCtx:
+    # The output is a growable bytearray, writing to it is amortized O(1).
+    # Expressions get a placeholder that postproc patches in place
     def __init__(self):
-        self.output_bytes = b''
+        self.output_bytes = bytearray()
 
         self.exprs = {} # {byte_position: string expression}
         self.label_contents = {} # {label name: position}
 
 
     def write_byte(self, b):
-        self.output_bytes = self.output_bytes + bytes([b])
+        self.output_bytes.append(b)
 
     def write_u64(self, b):
-        self.output_bytes = self.output_bytes + struct.pack("Q", b)
+        self.output_bytes += struct.pack("Q", b)
 
     def write_expr(self, expr):
         self.exprs[len(self.output_bytes)] = expr
@@ -26,13 +50,89 @@ class CompileCtx:
     def write_labelpos(self, label_name):
         self.label_contents[label_name] = len(self.output_bytes)
 
-    def postproc(self):
-        resulting_output = self.output_bytes
+    # (byte position, value) of every expression. Expressions that are just
+    # a label are looked up directly, the rest are parsed once and evaluated
+    # with one names dict for the whole pass
+    def fixups(self):
+        names = dict(self.label_contents)
+        evaluator = simpleeval.SimpleEval(names=names)
         for idx, expr in self.exprs.items():
-            value = simpleeval.simple_eval(expr, names={"$": idx, **self.label_contents})
+            value = self.label_contents.get(expr)
+            if value is None:
+                names["$"] = idx
+                value = evaluator.eval(expr, previously_parsed=parse_expr(expr))
+            assert(type(value) == int)
+            yield idx, value
+
+    def postproc(self):
+        for idx, value in self.fixups():
+            struct.pack_into("Q", self.output_bytes, idx, value)
+
+        return bytes(self.output_bytes)
+
+
+class StreamingCompileCtx(CompileCtx):
+    # Writes the output to the file out while compiling, which has to be
+    # seekable. An expression whose names are all labels that are already
+    # defined is evaluated when it is written. Only the rest, the forward
+    # references, are kept until finish patches them in the file.
+    #
+    # A label that an expression has already been evaluated with can't be
+    # defined again, as that expression would have had the last definition
+    # in a full build
+    def __init__(self, out):
+        super().__init__()
+        self.out = out
+        self.flushed = 0 # bytes of output already written to out
+
+        self.names = {}
+        self.evaluator = simpleeval.SimpleEval(names=self.names)
+        self.used_labels = set()
+
+    def position(self):
+        return self.flushed + len(self.output_bytes)
+
+    def write_expr(self, expr):
+        value = self.label_contents.get(expr)
+        if value is not None:
+            self.used_labels.add(expr)
+        elif expr_names(expr) <= self.label_contents.keys():
+            self.used_labels.update(expr_names(expr))
+            self.names["$"] = self.position()
+            value = self.evaluator.eval(expr, previously_parsed=parse_expr(expr))
             assert(type(value) == int)
-            enc = struct.pack("Q", value)
 
-            resulting_output = resulting_output[:idx] + enc + resulting_output[idx+len(enc):]
+        if value is None:
+            self.exprs[self.position()] = expr
+            self.write_u64(0x4142434445464748)
+        else:
+            self.write_u64(value)
+
+    def new_inst(self):
+        self.current_ip = self.position()
+
+    def write_labelpos(self, label_name):
+        if label_name in self.used_labels:
+            raise ValueError(f"Label {label_name!r} defined again after it was used")
+        self.label_contents[label_name] = self.names[label_name] = self.position()
+
+    # Writes out what has been compiled so far, once there's at least
+    # at_least bytes of it
+    def flush(self, at_least=FLUSH_SIZE):
+        if len(self.output_bytes) >= at_least:
+            self.out.write(self.output_bytes)
+            self.flushed += len(self.output_bytes)
+            self.output_bytes.clear()
+
+    # Writes the rest of the output and patches the forward references.
+    # Gives the size of the output
+    def finish(self):
+        self.flush(0)
+
+        for idx, value in self.fixups():
+            self.out.seek(idx)
+            self.out.write(struct.pack("Q", value))
 
-        return resulting_output
+        self.out.seek(self.flushed)
+        self.exprs = {}
+        return self.flushed
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import re
+import struct
+
+from parser import lex
+from instructions import ARGUMENTS, LabelDef, read_instructions
+from compile_ctx import CompileCtx
+
+# Part of every cache key, so changing how sections compile has to bump it
+CACHE_VERSION = 1
+
+U64 = struct.Struct("<Q")
+
+# A line starting with a labeldef starts a new section, unless it is inside
+# a py-expr
+SECTION_START = re.compile(r"^[ \t]*'", re.MULTILINE)
+
+# Splits the source into (line it starts on, text) sections. A section
+# starts at the start of a line, outside of any py-expr, with a label, so
+# no token or instruction spans two sections and every section compiles
+# the same by itself as in the whole source, except for where it ends up
+def split_sections(text):
+    sections = []
+    start = 0
+    line = 1
+    ticks = 0 # ` between the start of the text and at
+    at = 0
+    for m in SECTION_START.finditer(text):
+        ticks += text.count("`", at, m.start())
+        at = m.start()
+        if ticks % 2 == 1 or at == start:
+            continue
+
+        sections.append((line, text[start:at]))
+        line += text.count("\n", start, at)
+        start = at
+
+    sections.append((line, text[start:]))
+    return sections
+
+class Section:
+    # A compiled section, with label and expression positions relative to
+    # its start
+    def __init__(self, code, labels, exprs):
+        self.code = code
+        self.labels = labels # {label name: position}
+        self.exprs = exprs # {byte_position: string expression}
+
+    def encode(self):
+        buf = bytearray()
+
+        def write_bytes(val):
+            buf.extend(U64.pack(len(val)))
+            buf.extend(val)
+
+        write_bytes(self.code)
+        buf.extend(U64.pack(len(self.labels)))
+        for name, pos in self.labels.items():
+            write_bytes(name.encode())
+            buf.extend(U64.pack(pos))
+        buf.extend(U64.pack(len(self.exprs)))
+        for pos, expr in self.exprs.items():
+            buf.extend(U64.pack(pos))
+            write_bytes(expr.encode())
+        return bytes(buf)
+
+    @staticmethod
+    def decode(data):
+        at = 0
+
+        def read_u64():
+            nonlocal at
+            at += 8
+            return U64.unpack_from(data, at - 8)[0]
+
+        def read_bytes():
+            nonlocal at
+            n = read_u64()
+            at += n
+            return data[at - n:at]
+
+        code = read_bytes()
+        labels = {}
+        for _ in range(read_u64()):
+            name = read_bytes().decode()
+            labels[name] = read_u64()
+        exprs = {}
+        for _ in range(read_u64()):
+            pos = read_u64()
+            exprs[pos] = read_bytes().decode()
+        return Section(code, labels, exprs)
+
+# True if read_instructions would stop at an argument without an
+# instruction before it
+def has_invalid_token(tokens):
+    previous = "labeldef"
+    for _, cat in tokens:
+        if cat in ARGUMENTS and previous == "labeldef":
+            return True
+        previous = cat
+    return False
+
+# Gives the Section for the text, or None if it has a token that would end
+# the whole program there or defines a label twice
+def compile_section(text, line=1):
+    tokens = lex(text, line)
+    if has_invalid_token(tokens):
+        return None
+
+    ctx = CompileCtx()
+    for inst in read_instructions(tokens):
+        if isinstance(inst, LabelDef) and inst.name in ctx.label_contents:
+            return None
+        inst.compile_to_bytes(ctx)
+    return Section(bytes(ctx.output_bytes), ctx.label_contents, ctx.exprs)
+
+class SectionCache:
+    # Compiled sections in a directory, one file per section named after
+    # the hash of its text. hits and misses count the sections that were
+    # and weren't there
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        return hashlib.sha256(f"{CACHE_VERSION}\n{text}".encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".sec")
+
+    def get(self, text, line=1):
+        key = self.key(text)
+        try:
+            with open(self.path(key), "rb") as f:
+                section = Section.decode(f.read())
+            self.hits += 1
+            return section
+        except FileNotFoundError:
+            pass
+
+        self.misses += 1
+        section = compile_section(text, line)
+        if section is not None:
+            tmp_path = self.path(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(section.encode())
+            os.replace(tmp_path, self.path(key))
+        return section
+
+# Assembles the source with the sections in the cache, and adds the ones
+# that aren't. The sections are placed one after another and the labels and
+# expressions are moved along with them, then the expressions are evaluated
+# as in a full build. Gives the assembled bytes, or None if there is an
+# invalid token or a label defined twice. Only a full build reports those
+# the same way, as whether a label may be defined again depends on what used
+# it in between (see StreamingCompileCtx)
+def assemble_incremental(text, cache):
+    ctx = CompileCtx()
+    for line, section_text in split_sections(text):
+        section = cache.get(section_text, line)
+        if section is None:
+            return None
+
+        offset = len(ctx.output_bytes)
+        ctx.output_bytes += section.code
+        for name, pos in section.labels.items():
+            if name in ctx.label_contents:
+                return None
+            ctx.label_contents[name] = offset + pos
+        for pos, expr in section.exprs.items():
+            ctx.exprs[offset + pos] = expr
+
+    return ctx.postproc()
@@ -111,56 +111,45 @@ class LabelDef(Instruction):
     def __str__(self):
         return f'LabelDef({self.name})'
 
+ARGUMENTS = {
+    "constant": ConstantArgument,
+    "register": RegisterArgument,
+    "py-expr": PyExprArgument,
+}
+
+# Gives the instructions as they are read from the tokens, which can be any
+# iterable of cleaned up tokens
+def read_instructions(tokens):
+    current = None # (instname, [arglist]) while reading an instruction's arguments
+    previous = None
+
+    for token in tokens:
+        content, cat = token
+
+        if cat == "instruction" or cat == "labeldef":
+            if current is not None:
+                yield CpuInstruction(current[0], current[1])
+                current = None
+
+            if cat == "instruction":
+                current = (content, [])
+            else:
+                yield LabelDef(content)
+
+        elif cat in ARGUMENTS and current is not None:
+            current[1].append(ARGUMENTS[cat](content))
+
+        else:
+            print("Reached invalid token: ...", [previous, token], "<---")
+            return
+
+        previous = token
+
+    if current is not None:
+        yield CpuInstruction(current[0], current[1])
+
 def read_instlist(parsed_input):
-    parsed_input.append(("", "instruction"))
-    instlist = []
-
-    at = 0
-
-    # states:
-    #   ("outside", None)
-    #   ("parsing_args", (instname, [arglist])
-    current_state = ("outside", None)
-
-    while at < len(parsed_input):
-        content, cat = parsed_input[at]
-
-        if current_state[0] == "parsing_args" and cat in ["instruction", "labeldef"]:
-            instlist.append(
-                CpuInstruction(current_state[1][0], current_state[1][1])
-            )
-            current_state = ("outside", None)
-            continue
-
-        if cat == "instruction" and current_state[0] == "outside":
-            current_state = ("parsing_args", (content, []))
-            at += 1
-            continue
-
-        if cat == "labeldef" and current_state[0] == "outside":
-            instlist.append(LabelDef(content))
-            at += 1
-            continue
-
-        if cat == "constant" and current_state[0] == "parsing_args":
-            current_state[1][1].append(ConstantArgument(content))
-            at += 1
-            continue
-
-        if cat == "register" and current_state[0] == "parsing_args":
-            current_state[1][1].append(RegisterArgument(content))
-            at += 1
-            continue
-
-        if cat == "py-expr" and current_state[0] == "parsing_args":
-            current_state[1][1].append(PyExprArgument(content))
-            at += 1
-            continue
-
-        print("Reached invalid token: ...", parned_input[at-2:at], "<---")
-        break
-
-    return instlist
+    return list(read_instructions(parsed_input))
 
 
 if __name__ == "__main__":
@@ -1,4 +1,8 @@
+import functools
+import re
+import sys
 import unicodedata
+from collections import namedtuple
 
 # Instruction syntax:
 #   Inst (reg )*
@@ -13,99 +17,116 @@ import unicodedata
 # Constant syntax:
 # #`py-expr` is compiled into #N where N is the result of evaluating `py-expr`
 
-def assign_kinds(text):
-    # TODO: Turn this into classes with methods for transitions
-
-    transition_to_whitespace = (lambda ch: ch in " \t\n", "whitespace")
-    transition_to_register = (lambda ch: ch == "$", "register")
-    transition_to_constant = (lambda ch: ch == "#", "constant")
-    transition_to_pyexpr = (lambda ch: ch == "`", "py-expr")
-    transition_to_label = (lambda ch: ch == "'", "labeldef")
-
-    is_letter = lambda ch: unicodedata.category(ch)[0] == "L" or ch in "-_"
-    is_number = lambda ch: unicodedata.category(ch)[0] == "N"
-
-    transition_to_instruction = (is_letter, "instruction")
-
-    otherwise = lambda _: True
-
-    transition_table = {
-        "cat-break": [
-            transition_to_whitespace,
-            transition_to_register,
-            transition_to_constant,
-            transition_to_pyexpr,
-            transition_to_label,
-            transition_to_instruction,
-        ],
-        "instruction": [
-            (is_letter, "instruction"),
-            (otherwise, "cat-break"),
-        ],
-        "labeldef": [
-            (is_letter, "labeldef"),
-            (otherwise, "cat-break"),
-        ],
-        "register": [
-            (is_letter, "register"),
-            (otherwise, "cat-break"),
-        ],
-        "constant": [
-            (is_number, "constant"),
-            (otherwise, "cat-break"),
-        ],
-        "py-expr": [
-            (lambda x: x == '`', "py-expr-end"),
-            (otherwise, "py-expr"),
-        ],
-        "py-expr-end": [
-            (otherwise, "cat-break"),
-        ],
-        "whitespace": [
-            transition_to_whitespace,
-            (otherwise, "cat-break"),
-        ],
-    }
-
-    current_category = "cat-break"
-    at = 0
-    result = []
-    while at < len(text):
-        current_ch = text[at]
-        transition = None
-
-        for case, resulting_category in transition_table[current_category]:
-            if case(current_ch):
-                transition = resulting_category
-                break
-
-        if transition == None:
-            print("Unexpected", text[at-5:at+1], "<---")
-
-        if transition == "cat-break":
-            result.append(('', transition))
+# Every token is (text, category, position in the source). The tokens are
+# found by one regex, tried at every position in turn. Categories:
+#   whitespace   - spaces, tabs and newlines
+#   register     - $ followed by letters
+#   constant     - # followed by numbers
+#   py-expr      - ` and everything up to the next `
+#   py-expr-end  - the closing `
+#   labeldef     - ' followed by letters
+#   instruction  - letters
+# where letters are anything in unicode category L, and - and _, and
+# numbers are anything in unicode category N
+Token = namedtuple("Token", ["text", "cat", "pos"])
+
+TOKEN_PATTERN = r"""
+    (?P<whitespace>[ \t\n]+)
+  | (?P<register>\$LETTER*)
+  | (?P<constant>\#NUMBER*)
+  | (?P<py_expr>`[^`]*)(?P<py_expr_end>`)?
+  | (?P<labeldef>'LETTER*)
+  | (?P<instruction>LETTER+)
+"""
+
+CATEGORIES = {
+    "whitespace": "whitespace",
+    "register": "register",
+    "constant": "constant",
+    "py_expr": "py-expr",
+    "labeldef": "labeldef",
+    "instruction": "instruction",
+}
+
+def char_class(chars):
+    # [...] of ranges of the sorted code points in chars
+    ranges = []
+    for ch in chars:
+        if ranges and ranges[-1][1] == ch - 1:
+            ranges[-1][1] = ch
         else:
-            result.append((current_ch, transition))
-            at += 1
-
-        current_category = transition
-
-    return result
+            ranges.append([ch, ch])
+    return "[" + "".join(re.escape(chr(a)) if a == b else f"{re.escape(chr(a))}-{re.escape(chr(b))}" for a, b in ranges) + "]"
+
+# The same tokens as TOKEN_PATTERN, without categories: one group with the
+# token, after any whitespace. Anything else is matched outside the group,
+# so a character that doesn't start a token gives an empty token
+LEX_PATTERN = r"""
+    [ \t\n]*
+    (?:
+        (
+            \$LETTER*
+          | \#NUMBER*
+          | `[^`]*`?
+          | 'LETTER*
+          | LETTER+
+        )
+      | [^ \t\n]
+    )
+"""
+
+def compile_token_regexes(max_char):
+    letters = [ch for ch in range(max_char) if unicodedata.category(chr(ch))[0] == "L" or chr(ch) in "-_"]
+    numbers = [ch for ch in range(max_char) if unicodedata.category(chr(ch))[0] == "N"]
+
+    def compile(pattern):
+        pattern = pattern.replace("LETTER", char_class(letters)).replace("NUMBER", char_class(numbers))
+        return re.compile(pattern, re.VERBOSE)
+
+    return compile(TOKEN_PATTERN), compile(LEX_PATTERN)
+
+ASCII_TOKEN_REGEX, ASCII_LEX_REGEX = compile_token_regexes(0x80)
+
+# Going through all of unicode takes a while, so that is only done for
+# sources that aren't plain ASCII
+@functools.lru_cache(maxsize=None)
+def unicode_token_regexes():
+    return compile_token_regexes(sys.maxunicode + 1)
+
+def line_col(text, pos):
+    line = text.count("\n", 0, pos) + 1
+    col = pos - (text.rfind("\n", 0, pos) + 1) + 1
+    return line, col
+
+# line is the line text starts on, for error messages
+def scan(text, line=1):
+    regex = ASCII_TOKEN_REGEX if text.isascii() else unicode_token_regexes()[0]
+    match = regex.match
+    pos = 0
+    while pos < len(text):
+        m = match(text, pos)
+        if m is None:
+            at_line, col = line_col(text, pos)
+            raise ValueError(f"Unexpected {text[pos]!r} at line {line + at_line - 1}, column {col}: {text[max(pos-5, 0):pos+1]} <---")
+
+        kind = m.lastgroup
+        if kind == "py_expr_end":
+            yield Token(m.group("py_expr"), "py-expr", pos)
+            yield Token("`", "py-expr-end", m.start("py_expr_end"))
+        else:
+            yield Token(m.group(), CATEGORIES[kind], pos)
+        pos = m.end()
 
+# Tokens as (text, category), with a ('', 'cat-break') between tokens, like
+# the character by character tokenizer this replaced gave
 def tokenize(text):
-    assigned_cats = assign_kinds(text)
-    assigned_cats.append(('', 'cat-break'))
-
-    current_group, current_category = assigned_cats[0]
     result = []
-    for (ch, cat) in assigned_cats[1:]:
-        if cat == current_category or current_category == None:
-            current_group += ch
-            current_category = cat
-        else:
-            result.append((current_group, current_category))
-            current_group = ch
-            current_category = cat
+    previous = None
+    for token in scan(text):
+        if previous is not None and not (previous == "py-expr" and token.cat == "py-expr-end"):
+            result.append(('', 'cat-break'))
+        result.append((token.text, token.cat))
+        previous = token.cat
 
     return result
 
@@ -119,7 +140,7 @@ def cleanup(tokens):
             result.append((token, cat))
         if cat == "constant":
             assert(token[0] == "#")
-            result.append((int(token), cat))
+            result.append((int(token[1:]), cat))
         if cat == "py-expr":
             assert(token[0] == "`")
             result.append((token[1:], cat))
@@ -128,3 +149,50 @@ def cleanup(tokens):
             result.append((token[1:], cat))
 
     return result
+
+# cleanup(tokenize(text)), without making all the tokens that are thrown away.
+# The first character of a token tells its category. Positions aren't kept,
+# a source with a bad character is scanned again to tell where it is
+def lex(text, line=1):
+    regex = ASCII_LEX_REGEX if text.isascii() else unicode_token_regexes()[1]
+    result = []
+    append = result.append
+    for token in regex.findall(text):
+        if not token:
+            for _ in scan(text, line):
+                pass
+            raise AssertionError("scan accepted what lex didn't")
+
+        first = token[0]
+        if first == "$":
+            append((token[1:], "register"))
+        elif first == "#":
+            append((int(token[1:]), "constant"))
+        elif first == "`":
+            append((token[1:-1] if len(token) > 1 and token[-1] == "`" else token[1:], "py-expr"))
+        elif first == "'":
+            append((token[1:], "labeldef"))
+        else:
+            append((token, "instruction"))
+
+    return result
+
+# lex() of the text in chunks, joined, without having all of it at once.
+# Every chunk is lexed up to its last line that doesn't end inside a
+# py-expr, the rest goes in front of the next chunk. Every ` opens or closes
+# a py-expr, so a line ends outside of one if there's an even number of `
+# before it
+def lex_chunks(chunks):
+    rest = ""
+    line = 1
+    for chunk in chunks:
+        text = rest + chunk
+        cut = text.rfind("\n") + 1
+        if text.count("`", 0, cut) % 2 == 1:
+            cut = text.rfind("\n", 0, text.rfind("`", 0, cut)) + 1
+
+        yield from lex(text[:cut], line)
+        line += text.count("\n", 0, cut)
+        rest = text[cut:]
+
+    yield from lex(rest, line)
@@ -1,7 +1,15 @@
+import io
+import struct
+import tempfile
+import time
 import unittest
+from sys import argv
 
 from parser import *
-from compile_ctx import CompileCtx
+from assembler import assemble, assemble_file
+from compile_ctx import CompileCtx, StreamingCompileCtx
+from incremental import SectionCache, assemble_incremental, split_sections
+from instructions import ConstantArgument, CpuInstruction, LabelDef, PyExprArgument, RegisterArgument, read_instlist
 
 class TestTokenization(unittest.TestCase):
     def test_simple_with_whitespace(self):
@@ -66,6 +74,36 @@ class TestTokenization(unittest.TestCase):
             ]
         )
 
+    def test_positions(self):
+        self.assertEqual(
+            [token for token in scan("Set $ra\n  `x`") if token.cat != "whitespace"],
+            [ Token("Set", "instruction", 0)
+            , Token("$ra", "register", 4)
+            , Token("`x", "py-expr", 10)
+            , Token("`", "py-expr-end", 12)
+            ]
+        )
+        self.assertEqual(line_col("Set $ra\n  `x`", 10), (2, 3))
+
+        with self.assertRaises(ValueError):
+            tokenize("Set $ra 12")
+        with self.assertRaises(ValueError):
+            lex("Set $ra 12")
+
+    def test_unicode(self):
+        self.assertEqual(
+            tokenize("'répète Ж#٣"),
+            [ ("'répète", "labeldef")
+            , ('', 'cat-break')
+            , (" ", "whitespace")
+            , ('', 'cat-break')
+            , ("Ж", "instruction")
+            , ('', 'cat-break')
+            , ("#٣", "constant")
+            ]
+        )
+        self.assertEqual(lex("'répète Ж#٣"), cleanup(tokenize("'répète Ж#٣")))
+
     def test_cleanup(self):
         self.assertEqual(
             cleanup(tokenize("'x Set $ra `2+2`")),
@@ -76,6 +114,11 @@ class TestTokenization(unittest.TestCase):
             ]
         )
 
+        self.assertEqual(
+            lex("'x Set $ra #12 `2+2`"),
+            cleanup(tokenize("'x Set $ra #12 `2+2`")),
+        )
+
 
 class TestCompiler(unittest.TestCase):
     def test_write_bytes(self):
@@ -128,6 +171,213 @@ class TestCompiler(unittest.TestCase):
             b'\x22\x00\x00\x00\x00\x00\x00\x00\x88\x41\x00\x00\x00\x00\x00\x00\x00\xff\xff\xff\xff\xff\xff\xff\xff',
         )
 
+    def test_same_expression_in_different_programs(self):
+        # Parsed expressions are shared, their values aren't
+        outputs = []
+        for padding in [0, 3]:
+            ctx = CompileCtx()
+            for _ in range(padding):
+                ctx.write_byte(0)
+            ctx.write_labelpos('start')
+            ctx.write_expr('start * 2 + 1')
+            ctx.write_expr('start')
+            outputs.append(ctx.postproc()[padding:])
+
+        self.assertEqual(outputs[0], struct.pack("QQ", 1, 0))
+        self.assertEqual(outputs[1], struct.pack("QQ", 7, 3))
+
+class TestStreaming(unittest.TestCase):
+    SOURCE = """
+'start
+    Set $ra `end - start`
+    Add $rx $rx #12 Print `(
+        start + 1
+    )`
+'end
+    Set $ip `start`
+"""
+
+    def full_build(self, source):
+        ctx = CompileCtx()
+        for inst in read_instlist(lex(source)):
+            inst.compile_to_bytes(ctx)
+        return ctx.postproc()
+
+    def test_lex_chunks(self):
+        for size in range(1, len(self.SOURCE) + 1):
+            chunks = [self.SOURCE[i:i + size] for i in range(0, len(self.SOURCE), size)]
+            self.assertEqual(list(lex_chunks(chunks)), lex(self.SOURCE))
+
+        with self.assertRaises(ValueError) as raised:
+            list(lex_chunks(["Set\n`\n", "`\n Set 1"]))
+        self.assertIn("line 4, column 6", str(raised.exception))
+
+    def test_same_as_full_build(self):
+        # Big enough to be flushed more than once
+        for source in [self.SOURCE, generate_source(20000)]:
+            out = io.BytesIO()
+            size = assemble(io.StringIO(source), out, chunk_size=1000)
+            self.assertEqual(out.getvalue(), self.full_build(source))
+            self.assertEqual(size, len(out.getvalue()))
+
+    def test_only_forward_references_kept(self):
+        ctx = StreamingCompileCtx(io.BytesIO())
+        ctx.write_labelpos('back')
+        ctx.write_expr('back + 1')
+        ctx.write_expr('forward')
+        ctx.write_labelpos('forward')
+        self.assertEqual(ctx.exprs, {8: 'forward'})
+
+        ctx.finish()
+        self.assertEqual(ctx.out.getvalue(), struct.pack("QQ", 1, 16))
+
+    def test_label_redefined_after_use(self):
+        ctx = StreamingCompileCtx(io.BytesIO())
+        ctx.write_labelpos('here')
+        ctx.write_expr('here')
+        with self.assertRaises(ValueError):
+            ctx.write_labelpos('here')
+
+class TestIncremental(unittest.TestCase):
+    def full_build(self, source):
+        out = io.BytesIO()
+        assemble(io.StringIO(source), out)
+        return out.getvalue()
+
+    def test_split_sections(self):
+        self.assertEqual(
+            split_sections("Set $ra #1\n'a Print `(\n'notalabel)`\n  'b\n'c 'd"),
+            [ (1, "Set $ra #1\n")
+            , (2, "'a Print `(\n'notalabel)`\n")
+            , (4, "  'b\n")
+            , (5, "'c 'd")
+            ]
+        )
+
+    def test_same_as_full_build(self):
+        source = generate_source(2000)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SectionCache(directory)
+            self.assertEqual(assemble_incremental(source, cache), self.full_build(source))
+            self.assertEqual(cache.hits, 0)
+
+            # Growing a block moves every label after it
+            edited = source.replace("Add $rx $rx #100\n", "Add $rx $rx #100\n    Print `inserted + 1`\n'inserted\n")
+            cache = SectionCache(directory)
+            self.assertEqual(assemble_incremental(edited, cache), self.full_build(edited))
+            self.assertEqual(cache.misses, 2)
+
+    def test_invalid_token(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsNone(assemble_incremental("'a Set $ra\n'b #1 Set $ra", SectionCache(directory)))
+
+    def test_label_defined_twice(self):
+        used_in_between = "'a\nSet $ip `a`\n'a\nSet $rx #1\n"
+        used_after = "'a\nSet $rx #1\n'a Set $ry #2\n'a\nSet $ip `a`\n"
+
+        with tempfile.TemporaryDirectory() as directory:
+            inpath = f"{directory}/in.asm"
+            outpath = f"{directory}/out.bin"
+            for cache_dir in [None, f"{directory}/cache"]:
+                with open(inpath, "w") as f:
+                    f.write(used_in_between)
+                with self.assertRaises(ValueError):
+                    assemble_file(inpath, outpath, cache_dir)
+
+                with open(inpath, "w") as f:
+                    f.write(used_after)
+                assemble_file(inpath, outpath, cache_dir)
+                with open(outpath, "rb") as f:
+                    self.assertEqual(f.read(), self.full_build(used_after))
+
+# n_instructions instructions in blocks of 64, every block starting with a
+# label and ending with a jump to one of 16 of them
+def generate_instlist(n_instructions):
+    instlist = []
+    for i in range(n_instructions):
+        if i % 64 == 0:
+            instlist.append(LabelDef(f"block{i // 64}"))
+        if i % 64 == 63:
+            instlist.append(CpuInstruction("Set", [RegisterArgument("ip"), PyExprArgument(f"block{i // 64 % 16}")]))
+        else:
+            instlist.append(CpuInstruction("Add", [RegisterArgument("rx"), RegisterArgument("rx"), ConstantArgument(i)]))
+    return instlist
+
+# Labels can only have letters in them
+def letters(n):
+    name = ""
+    while True:
+        name = chr(ord("a") + n % 26) + name
+        n //= 26
+        if n == 0:
+            return name
+
+# Source of the same program as generate_instlist
+def generate_source(n_instructions):
+    lines = []
+    for i in range(n_instructions):
+        if i % 64 == 0:
+            lines.append(f"'block{letters(i // 64)}")
+        if i % 64 == 63:
+            lines.append(f"    Set $ip `block{letters(i // 64 % 16)}`")
+        else:
+            lines.append(f"    Add $rx $rx #{i}")
+    return "\n".join(lines) + "\n"
+
+def benchmark():
+    print("== Tokenizing")
+    for n_instructions in [1000, 10000, 100000, 1000000]:
+        source = generate_source(n_instructions)
+
+        start = time.perf_counter()
+        lex(source)
+        took = time.perf_counter() - start
+
+        print(f"{n_instructions:>8} instructions: {took:7.3f}s, {len(source) / took / 1e6:5.2f} MB/s")
+
+    print("== Compiling instructions")
+    for n_instructions in [1000, 10000, 100000, 1000000]:
+        instlist = generate_instlist(n_instructions)
+
+        start = time.perf_counter()
+        ctx = CompileCtx()
+        for inst in instlist:
+            inst.compile_to_bytes(ctx)
+        ctx.postproc()
+        took = time.perf_counter() - start
+
+        print(f"{n_instructions:>8} instructions: {took:7.3f}s, {took / n_instructions * 1e6:5.2f} us/instruction")
+
+    print("== Assembling a file")
+    for n_instructions in [1000, 10000, 100000, 1000000]:
+        source = generate_source(n_instructions)
+
+        with tempfile.TemporaryFile("w+") as inf, tempfile.TemporaryFile() as out:
+            inf.write(source)
+            inf.seek(0)
+
+            start = time.perf_counter()
+            assemble(inf, out)
+            took = time.perf_counter() - start
+
+        print(f"{n_instructions:>8} instructions: {took:7.3f}s, {took / n_instructions * 1e6:5.2f} us/instruction")
+
+    print("== Re-assembling after changing one section")
+    for n_instructions in [1000, 10000, 100000, 1000000]:
+        source = generate_source(n_instructions)
+        edited = source.replace("Add $rx $rx #100\n", "Add $rx $rx #100\n    Add $rx $rx #100\n")
+
+        with tempfile.TemporaryDirectory() as directory:
+            assemble_incremental(source, SectionCache(directory))
+
+            start = time.perf_counter()
+            assemble_incremental(edited, SectionCache(directory))
+            took = time.perf_counter() - start
+
+        print(f"{n_instructions:>8} instructions: {took:7.3f}s, {took / n_instructions * 1e6:5.2f} us/instruction")
 
 if __name__ == '__main__':
-    unittest.main()
+    if argv[1:] == ["bench"]:
+        benchmark()
+    else:
+        unittest.main()
@@ -1,5 +1,8 @@
 from abc import ABC, abstractmethod
 
+from ram import U64_MASK
+from regfile import REGISTER_SLOTS
+
 class Action(ABC):
     @abstractmethod
     def __str__(self):
@@ -18,15 +21,36 @@ class Action(ABC):
     def __eq__(self, other):
         pass
 
+    # Hashable key that is equal for two actions exactly when they are ==,
+    # so answers can be grouped in a dict instead of comparing every pair
+    @abstractmethod
+    def key(self):
+        pass
+
+    # Also records what changed in vm.deltas, if anybody is listening
     @abstractmethod
     def run(self, vm):
         pass
 
+    # JSON-able form, for sending over the websocket. All numbers are hex
+    # strings, as javascript can't represent all 64 bit numbers
+    @abstractmethod
+    def to_dict(self):
+        pass
+
+def from_dict(d):
+    return ACTION_KINDS[d["kind"]].from_dict(d)
+
+def unhex(val):
+    return int(val, 16)
+
 class WriteToCPU(Action):
+    # Registers and RAM hold u64s, so the values are wrapped around to
+    # those already. -1 and 0xffffffffffffffff are the same answer
     def __init__(self, cpu_addr, new_ram, new_regs):
         self.cpu_addr = cpu_addr
-        self.new_ram = new_ram
-        self.new_regs = new_regs
+        self.new_ram = {addr: val & U64_MASK for addr, val in new_ram.items()}
+        self.new_regs = {reg: val & U64_MASK for reg, val in new_regs.items()}
 
     def affects(self):
         return [self.cpu_addr]
@@ -37,6 +61,9 @@ class WriteToCPU(Action):
 
         return self.cpu_addr == other.cpu_addr and self.new_ram == other.new_ram and self.new_regs == other.new_regs
 
+    def key(self):
+        return ("WriteToCPU", self.cpu_addr, frozenset(self.new_ram.items()), frozenset(self.new_regs.items()))
+
     def __str__(self):
         return f"WriteToCPU(cpu_addr={hex(self.cpu_addr)}, new_ram={self.new_ram}, new_regs={self.new_regs})"
 
@@ -47,7 +74,30 @@ class WriteToCPU(Action):
             core.ram[addr] = val
 
         for reg, val in self.new_regs.items():
-            core.registers[reg] = val
+            core.regfile[REGISTER_SLOTS[reg]] = val
+
+        if vm.deltas is not None:
+            vm.deltas.ram(core, self.new_ram)
+            vm.deltas.regs(core, self.new_regs)
+
+        vm.core_changed(core)
+
+    def to_dict(self):
+        return {
+            "kind": "WriteToCPU",
+            "cpu_addr": hex(self.cpu_addr),
+            "new_ram": {hex(addr): hex(val) for addr, val in self.new_ram.items()},
+            "new_regs": {reg: hex(val) for reg, val in self.new_regs.items()},
+        }
+
+    def from_dict(d):
+        new_regs = {reg: unhex(val) for reg, val in d["new_regs"].items()}
+        assert(all(reg in REGISTER_SLOTS for reg in new_regs))
+        return WriteToCPU(
+            unhex(d["cpu_addr"]),
+            {unhex(addr): unhex(val) for addr, val in d["new_ram"].items()},
+            new_regs,
+        )
 
 class MakeNewHandler(Action):
     def __init__(self, cpu_addr, atom, n_args, write_args_to, run_ip):
@@ -68,6 +118,9 @@ class MakeNewHandler(Action):
             and self.n_args == other.n_args and self.write_args_to == other.write_args_to \
             and self.run_ip == other.run_ip
 
+    def key(self):
+        return ("MakeNewHandler", self.cpu_addr, self.atom, self.n_args, self.write_args_to, self.run_ip)
+
     def __str__(self):
         args = []
         args.append(f"cpu_addr={hex(self.cpu_addr)}")
@@ -82,6 +135,22 @@ class MakeNewHandler(Action):
 
         core.handlers[self.atom] = (self.n_args, self.write_args_to, self.run_ip)
 
+        if vm.deltas is not None:
+            vm.deltas.handler(core, self.atom)
+
+    def to_dict(self):
+        return {
+            "kind": "MakeNewHandler",
+            "cpu_addr": hex(self.cpu_addr),
+            "atom": hex(self.atom),
+            "n_args": hex(self.n_args),
+            "write_args_to": hex(self.write_args_to),
+            "run_ip": hex(self.run_ip),
+        }
+
+    def from_dict(d):
+        return MakeNewHandler(unhex(d["cpu_addr"]), unhex(d["atom"]), unhex(d["n_args"]), unhex(d["write_args_to"]), unhex(d["run_ip"]))
+
 class SendMessage(Action):
     def __init__(self, receiver, atom, content):
         self.receiver = receiver
@@ -98,13 +167,74 @@ class SendMessage(Action):
         return self.receiver == other.receiver and self.atom == other.atom \
             and self.content == other.content
 
+    def key(self):
+        return ("SendMessage", self.receiver, self.atom, tuple(self.content))
+
     def __str__(self):
         return f"SendMessage(receiver={hex(self.receiver)}, atom={hex(self.atom)}, content={self.content})"
 
     def run(self, vm):
         core = vm.get_core_with_addr(self.receiver)
 
-        core.receive_message(self.atom, self.content)
+        handled = core.receive_message(self.atom, self.content)
+
+        if handled and vm.deltas is not None:
+            vm.deltas.handled(core, self.atom, self.content)
+
+        vm.core_changed(core)
+
+    def to_dict(self):
+        return {
+            "kind": "SendMessage",
+            "receiver": hex(self.receiver),
+            "atom": hex(self.atom),
+            "content": [hex(val) for val in self.content],
+        }
+
+    def from_dict(d):
+        return SendMessage(unhex(d["receiver"]), unhex(d["atom"]), [unhex(val) for val in d["content"]])
+
+class GoIdle(Action):
+    def __init__(self, cpu_addr):
+        self.cpu_addr = cpu_addr
+
+    def affects(self):
+        return [self.cpu_addr]
+
+    def __eq__(self, other):
+        if not isinstance(other, GoIdle):
+            return False
+
+        return self.cpu_addr == other.cpu_addr
+
+    def key(self):
+        return ("GoIdle", self.cpu_addr)
+
+    def __str__(self):
+        return f"GoIdle(cpu_addr={hex(self.cpu_addr)})"
+
+    def run(self, vm):
+        core = vm.get_core_with_addr(self.cpu_addr)
+
+        msg = core.go_idle()
+
+        if vm.deltas is not None:
+            vm.deltas.idle(core)
+            if msg is not None:
+                vm.deltas.handled(core, *msg)
+
+        # Only a core's own instructions can give it a handler, so without
+        # any it can never run again
+        if core.idle and not core.handlers and core.address in vm.cores:
+            vm.remove_actor(core.address)
+        else:
+            vm.core_changed(core)
+
+    def to_dict(self):
+        return {"kind": "GoIdle", "cpu_addr": hex(self.cpu_addr)}
+
+    def from_dict(d):
+        return GoIdle(unhex(d["cpu_addr"]))
 
 class Print(Action):
     def __init__(self, msg):
@@ -119,12 +249,24 @@ class Print(Action):
 
         return self.msg == other.msg
 
+    def key(self):
+        return ("Print", tuple(self.msg))
+
     def __str__(self):
         return f"Print(msg={self.msg})"
 
     def run(self, vm):
         vm.print_message(self.msg)
 
+        if vm.deltas is not None:
+            vm.deltas.print(self.msg)
+
+    def to_dict(self):
+        return {"kind": "Print", "msg": [hex(val) for val in self.msg]}
+
+    def from_dict(d):
+        return Print([unhex(val) for val in d["msg"]])
+
 class CreateActor(Action):
     def __init__(self, new_actor_addr, run_ip, creator_addr):
         self.new_actor_addr = new_actor_addr
@@ -141,8 +283,34 @@ class CreateActor(Action):
         # Intentionally skip comparing new_actor_addr as it is arbitrary
         return self.run_ip == other.run_ip and self.creator_addr == other.creator_addr
 
+    def key(self):
+        return ("CreateActor", self.run_ip, self.creator_addr)
+
     def __str__(self):
         return f"CreateActor(new_actor_addr={hex(self.new_actor_addr)}, run_ip={hex(self.run_ip)}, creator_addr={hex(self.creator_addr)})"
 
     def run(self, vm):
-        vm.new_actor(self.new_actor_addr, self.run_ip)
+        # None if the address is taken, or lives in another shard
+        core = vm.new_actor(self.new_actor_addr, self.run_ip, self.creator_addr)
+        if vm.deltas is not None and core is not None:
+            vm.deltas.created(core)
+
+    def to_dict(self):
+        return {
+            "kind": "CreateActor",
+            "new_actor_addr": hex(self.new_actor_addr),
+            "run_ip": hex(self.run_ip),
+            "creator_addr": hex(self.creator_addr),
+        }
+
+    def from_dict(d):
+        return CreateActor(unhex(d["new_actor_addr"]), unhex(d["run_ip"]), unhex(d["creator_addr"]))
+
+ACTION_KINDS = {
+    "WriteToCPU": WriteToCPU,
+    "MakeNewHandler": MakeNewHandler,
+    "SendMessage": SendMessage,
+    "GoIdle": GoIdle,
+    "Print": Print,
+    "CreateActor": CreateActor,
+}
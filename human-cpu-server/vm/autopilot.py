@@ -0,0 +1,117 @@
+import zlib
+
+from blocks import BlockCompiler
+from log import VM_LOG
+from regfile import IP_SLOT
+
+# How many instructions a core gets to run before the next one gets a turn
+QUANTUM = 1000
+
+class Autopilot:
+    # Runs the VM without any humans, using the instructions' own idea of
+    # what should happen. Instructions that only touch their own core are
+    # run directly through Instruction.make_executor, everything else goes
+    # through fake_action and the resulting Action.
+    #
+    # After an instruction $ip moves on to the next instruction, unless the
+    # instruction itself changed $ip
+    #
+    # With use_blocks, whole basic blocks are compiled into one function each
+    # (see blocks.py) and only instructions outside of them run one at a time
+    def __init__(self, vm, use_blocks=True):
+        self.vm = vm
+        self.use_blocks = use_blocks
+        self.block_compiler = BlockCompiler(vm.decoder)
+
+        self.compiled = {} # ip: (executor or None, length, req_addr -> Instruction), or None
+        self.blocks = {} # ip: (block function, number of instructions), or None
+        self.code_checksum = zlib.crc32(vm.decoder.code)
+
+    # Everything cached is only valid as long as the code stays the same
+    def check_code(self):
+        checksum = zlib.crc32(self.vm.decoder.code)
+        if checksum != self.code_checksum:
+            VM_LOG.info("Autopilot: the code changed, throwing away compiled code")
+            self.code_checksum = checksum
+            self.compiled = {}
+            self.blocks = {}
+            self.vm.decoder.invalidate()
+
+    def compile(self, ip):
+        decoded = self.vm.decoder.decode(ip)
+        if decoded is None:
+            res = None
+        else:
+            inst_init, length = decoded
+            res = (inst_init(0).make_executor(), length, inst_init)
+
+        self.compiled[ip] = res
+        return res
+
+    # Runs until steps instructions have been run, or until no core has
+    # anything left to run. Gives how many instructions were run
+    def run(self, steps=None, quantum=QUANTUM):
+        self.check_code()
+
+        executed = 0
+        while steps is None or executed < steps:
+            cores = self.vm.scheduler.pick()
+            if not cores:
+                VM_LOG.info("Autopilot: no runnable cores left")
+                break
+
+            for core in cores:
+                budget = quantum if steps is None else min(quantum, steps - executed)
+                if budget <= 0:
+                    break
+                executed += self.run_core(core, budget)
+
+        return executed
+
+    def run_core(self, core, budget):
+        vm = self.vm
+        compiled = self.compiled
+        blocks = self.blocks if self.use_blocks else None
+        regfile = core.regfile
+
+        n = 0
+        try:
+            while n < budget:
+                ip = regfile[IP_SLOT]
+
+                if blocks is not None:
+                    try:
+                        block = blocks[ip]
+                    except KeyError:
+                        block = blocks[ip] = self.block_compiler.compile(ip)
+
+                    if block is not None and block[1] <= budget - n:
+                        block[0](core)
+                        n += block[1]
+                        continue
+
+                try:
+                    entry = compiled[ip]
+                except KeyError:
+                    entry = self.compile(ip)
+                if entry is None:
+                    break
+
+                executor, length, inst_init = entry
+                n += 1
+                if executor is not None:
+                    executor(core)
+                else:
+                    inst_init(core.address).fake_action(core).run(vm)
+
+                if regfile[IP_SLOT] == ip:
+                    regfile[IP_SLOT] = ip + length
+
+                if core.idle or core.address not in vm.cores:
+                    break
+        except Exception as error:
+            # Only this core stops, the others keep running
+            vm.fault(core, error)
+
+        vm.core_changed(core)
+        return n
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+
+def is_global(act):
+    return 0 in act.affects()
+
+# Splits a list of actions into segments, in order. A segment is either
+#   ("barrier", action) - a global action, which has to run on its own
+#   ("groups", [[action]]) - actions between two barriers, grouped so that
+#       no two groups touch the same core. Each group keeps the original order
+def partition(actions):
+    segments = []
+    pending = []
+
+    for act in actions:
+        if is_global(act):
+            if pending:
+                segments.append(("groups", group_by_core(pending)))
+                pending = []
+            segments.append(("barrier", act))
+        else:
+            pending.append(act)
+
+    if pending:
+        segments.append(("groups", group_by_core(pending)))
+
+    return segments
+
+def group_by_core(actions):
+    # Union-find over core addresses, as an action may touch several cores
+    parent = {}
+
+    def find(addr):
+        parent.setdefault(addr, addr)
+        while parent[addr] != addr:
+            parent[addr] = parent[parent[addr]]
+            addr = parent[addr]
+        return addr
+
+    for act in actions:
+        first, *rest = act.affects()
+        for addr in rest:
+            parent[find(addr)] = find(first)
+
+    groups = {} # root addr: [action]
+    for act in actions:
+        groups.setdefault(find(act.affects()[0]), []).append(act)
+
+    return list(groups.values())
+
+class BatchExecutor:
+    # Applies a batch of actions, running the actions for different cores
+    # concurrently. The end result is the same as running them one by one
+    def __init__(self, vm, max_workers=None):
+        self.vm = vm
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def run(self, actions):
+        for kind, content in partition(actions):
+            if kind == "barrier":
+                content.run(self.vm)
+            else:
+                self.run_groups(content)
+
+    def run_groups(self, groups):
+        if len(groups) == 1:
+            self.run_group(groups[0])
+            return
+
+        # The scheduler isn't thread safe, so its updates wait until every
+        # group is done
+        self.vm.deferred_changes = []
+        try:
+            for future in [self.pool.submit(self.run_group, group) for group in groups]:
+                future.result()
+        finally:
+            changed, self.vm.deferred_changes = self.vm.deferred_changes, None
+            for core in changed:
+                self.vm.core_changed(core)
+
+    def run_group(self, group):
+        for act in group:
+            act.run(self.vm)
+
+    def shutdown(self):
+        self.pool.shutdown()
@@ -0,0 +1,175 @@
+import logging
+import random
+import sys
+import timeit
+from sys import argv
+
+# Making thousands of CPUs would otherwise log every single one of them
+logging.disable(logging.INFO)
+
+import instruction
+import vm
+
+def bench_core_lookup():
+    print("== Core lookup")
+    for n_cores in [10, 100, 1000, 10000, 100000]:
+        virt = vm.VirtualMachine(b"")
+        for _ in range(n_cores - 1):
+            virt.new_actor(random.getrandbits(64), 0)
+
+        addrs = [core.address for core in virt.cores]
+        lookups = [random.choice(addrs) for _ in range(10000)]
+
+        def run():
+            for addr in lookups:
+                virt.get_core_with_addr(addr)
+
+        took = min(timeit.repeat(run, number=1, repeat=5))
+        print(f"{n_cores:>7} cores: {took / len(lookups) * 1e9:8.1f} ns/lookup")
+
+# Set $ra #0x1234
+SET_RA = b"SAN\x34\x12\x00\x00\x00\x00\x00\x00"
+
+def bench_fetch():
+    print("== Instruction fetch")
+    for n_insts in [10, 1000, 100000]:
+        virt = vm.VirtualMachine(SET_RA * n_insts)
+        core = virt.cores.first()
+        core.registers["ip"] = (n_insts // 2) * len(SET_RA)
+
+        took = min(timeit.repeat(core.query_instructions, number=10000, repeat=5))
+        print(f"{n_insts:>7} instructions: {took / 10000 * 1e9:8.1f} ns/fetch")
+
+def bench_dispatch():
+    print("== Opcode dispatch")
+
+    chain_parsers = [
+        instruction.Set.parse,
+        instruction.SetMem.parse,
+        instruction.ReadMem.parse,
+        instruction.parser_any(*instruction.Arithmetic.parse.parsers_by_tag.values()),
+        instruction.SendMessage.parse,
+        instruction.MakeHandler.parse,
+        instruction.Selfaddr.parse,
+        instruction.CreateActor.parse,
+    ]
+    parse_chain = instruction.parser_any(*chain_parsers)
+
+    # Set $ra $rx, and GE $ra $rx #1 which is close to the end of the chain
+    for name, code in [("Set", b"SAx"), ("GE", b"]AxN\x01\x00\x00\x00\x00\x00\x00\x00")]:
+        for parser_name, parse in [("parser_any", parse_chain), ("dispatch", instruction.parse_instruction)]:
+            took = min(timeit.repeat(lambda: parse(code, 0), number=10000, repeat=5))
+            print(f"{name:>4} with {parser_name:<10}: {took / 10000 * 1e9:8.1f} ns/decode")
+
+def bench_schedule():
+    print("== Scheduling a step with 10 runnable cores")
+    # Set $ra $rx, then Idle
+    code = b"SAxI"
+    for n_cores in [100, 10000, 100000]:
+        virt = vm.VirtualMachine(code)
+        for i in range(n_cores - 1):
+            virt.new_actor(random.getrandbits(64), 0 if i < 9 else 3)
+        for core in virt.cores:
+            if core.registers["ip"] == 3:
+                core.go_idle()
+                virt.core_changed(core)
+
+        took = min(timeit.repeat(virt.query_instructions, number=100, repeat=5))
+        print(f"{n_cores:>7} cores: {took / 100 * 1e6:8.1f} us/step")
+
+def bench_lockstep():
+    from autopilot import Autopilot
+    from lockstep import LockstepEngine
+
+    print("== 100k actors running the same loop")
+    # Ten times Add $rx $rx #1, then Set $ip #0
+    code = b"+xxN\x01\x00\x00\x00\x00\x00\x00\x00" * 10 + b"S@N\x00\x00\x00\x00\x00\x00\x00\x00"
+    n_actors = 100000
+    steps = 1000 * n_actors
+
+    for name, make_engine in [("autopilot", Autopilot), ("lockstep", LockstepEngine)]:
+        virt = vm.VirtualMachine(code)
+        for _ in range(n_actors - 1):
+            virt.new_actor(random.getrandbits(64), 0)
+
+        engine = make_engine(virt)
+        start = timeit.default_timer()
+        executed = engine.run(steps)
+        took = timeit.default_timer() - start
+        print(f"{name:>9}: {executed} instructions in {took:6.2f}s ({executed / took:,.0f} instructions/s)")
+
+def bench_sharded():
+    import os
+    import subprocess
+    import tempfile
+    from sharded import ShardedVM
+
+    print("== simple.asm spawn-and-message on a sharded VM")
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "simple.bin")
+        subprocess.run([sys.executable, "assembler.py", "../assembly-files/simple.asm", out], cwd=os.path.join(here, "../assembler"), check=True)
+        with open(out, "rb") as f:
+            code = f.read()
+
+    n_actors = 20000
+    for n_shards in range(1, (os.cpu_count() or 1) + 2):
+        start = timeit.default_timer()
+        sharded = ShardedVM(code, n_shards, n_actors=n_actors)
+        executed = sharded.run()
+        sharded.close()
+        took = timeit.default_timer() - start
+        print(f"{n_shards:>2} shards: {executed} instructions in {took:6.2f}s ({executed / took:,.0f} instructions/s)")
+
+def bench_snapshot():
+    import tempfile
+    from snapshot import SnapshotStore, capture
+
+    print("== Snapshots")
+    for n_cores in [1000, 10000, 50000]:
+        virt = vm.VirtualMachine(b"I")
+        for _ in range(n_cores - 1):
+            virt.new_actor(random.getrandbits(64), 0)
+        for core in virt.cores:
+            for i in range(8):
+                core.ram[random.getrandbits(20)] = i + 1
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = SnapshotStore(directory)
+
+            start = timeit.default_timer()
+            image = capture(virt)
+            took_capture = timeit.default_timer() - start
+            store.write(image)
+            took_full = timeit.default_timer() - start
+
+            # Change 1% of the cores
+            for core in random.sample(list(virt.cores), n_cores // 100):
+                core.ram[0] = 1
+            start = timeit.default_timer()
+            n_pages = store.n_pages
+            store.save(virt)
+            took_incremental = timeit.default_timer() - start
+            new_pages = store.n_pages - n_pages
+
+            start = timeit.default_timer()
+            SnapshotStore(directory).restore()
+            took_restore = timeit.default_timer() - start
+
+        print(f"{n_cores:>6} cores: capture {took_capture * 1000:7.1f} ms, full {took_full * 1000:7.1f} ms, "
+            f"1% changed {took_incremental * 1000:7.1f} ms ({new_pages} pages), restore {took_restore * 1000:7.1f} ms")
+
+BENCHMARKS = {
+    "core-lookup": bench_core_lookup,
+    "fetch": bench_fetch,
+    "dispatch": bench_dispatch,
+    "schedule": bench_schedule,
+    "lockstep": bench_lockstep,
+    "sharded": bench_sharded,
+    "snapshot": bench_snapshot,
+}
+
+if __name__ == "__main__":
+    names = argv[1:] if len(argv) > 1 else BENCHMARKS.keys()
+    for name in names:
+        BENCHMARKS[name]()
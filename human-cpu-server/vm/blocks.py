@@ -0,0 +1,61 @@
+from log import VM_LOG
+from regfile import IP_SLOT
+
+# Longest run of instructions compiled into one block
+MAX_BLOCK_LEN = 256
+
+class BlockCompiler:
+    # Compiles basic blocks, runs of instructions that only touch their own
+    # core, into a single python function. Operands are resolved while
+    # compiling, so constants end up inlined and registers become direct
+    # indexing into the register file.
+    #
+    # A block ends before the first instruction that has to go through an
+    # Action, or after the first instruction that changes $ip
+    def __init__(self, decoder):
+        self.decoder = decoder
+
+    # Gives (function cpu -> None, number of instructions), or None if the
+    # instruction at ip can't be compiled
+    def compile(self, ip):
+        lines = []
+        n_instructions = 0
+        at = ip
+        ends_with_jump = False
+        while n_instructions < MAX_BLOCK_LEN:
+            decoded = self.decoder.decode(at)
+            if decoded is None:
+                break
+            inst_init, length = decoded
+
+            inst = inst_init(0)
+            source = inst.make_source(at)
+            if source is None:
+                break
+
+            # If it raises, $ip has to be at it, with everything before it done
+            if inst.may_raise():
+                lines.append(f"r[{IP_SLOT}] = {hex(at)}")
+            lines.append(source)
+            n_instructions += 1
+            if inst.writes_ip():
+                # Same as running one instruction at a time: only move on
+                # if the instruction didn't go anywhere
+                lines.append(f"if r[{IP_SLOT}] == {hex(at)}: r[{IP_SLOT}] = {hex(at + length)}")
+                ends_with_jump = True
+                break
+            at += length
+
+        if not lines:
+            return None
+
+        if not ends_with_jump:
+            lines.append(f"r[{IP_SLOT}] = {hex(at)}")
+
+        body = "\n".join("    " + line for line in lines)
+        source = f"def block(cpu):\n    r = cpu.regfile\n    ram = cpu.ram\n    addr = cpu.address\n{body}\n"
+
+        namespace = {}
+        exec(compile(source, f"<block at {hex(ip)}>", "exec"), namespace)
+        VM_LOG.debug(f"Compiled a block of {n_instructions} instructions at {hex(ip)}")
+        return namespace["block"], n_instructions
@@ -0,0 +1,76 @@
+from log import SERVER_LOG
+
+class Decision:
+    def __init__(self, action, weight, total_weight, n_answers, agrees):
+        self.action = action
+        self.weight = weight # weight of the answers that voted for action
+        self.total_weight = total_weight
+        self.n_answers = n_answers
+        self.agrees = agrees # is action the same as the instruction's fake_action
+
+    def __str__(self):
+        return f"Decision(action={self.action}, weight={self.weight}/{self.total_weight}, agrees={self.agrees})"
+
+class Ballot:
+    # Collects the answers to one instruction. Answers are grouped by
+    # Action.key(), so equal answers (by Action.__eq__) end up in the same
+    # bucket without having to compare every pair.
+    #
+    # A decision is made as soon as one answer has quorum weight behind it,
+    # or once max_answers answers are in. In the latter case the heaviest
+    # answer wins, ties go to whatever agrees with fake_action and then to
+    # whatever came first
+    def __init__(self, expected, quorum, max_answers):
+        self.expected_key = expected.key()
+        self.quorum = quorum
+        self.max_answers = max_answers
+
+        self.buckets = {} # key: [first action with that key, total weight, voters]
+        self.voters = set()
+        self.total_weight = 0
+        self.decision = None
+
+    # Gives the Decision if this answer decided the ballot, None otherwise.
+    # Answers after the decision and repeated answers from the same voter
+    # are ignored
+    def add(self, voter, act, weight=1):
+        if self.decision is not None or voter in self.voters:
+            return None
+
+        self.voters.add(voter)
+        self.total_weight += weight
+
+        key = act.key()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [act, 0, []]
+        bucket[1] += weight
+        bucket[2].append(voter)
+
+        if bucket[1] >= self.quorum:
+            return self.decide(key)
+        if len(self.voters) >= self.max_answers:
+            return self.decide(self.leader())
+        return None
+
+    def leader(self):
+        # dicts keep insertion order and max keeps the first of equals
+        return max(self.buckets, key=lambda key: (self.buckets[key][1], key == self.expected_key))
+
+    def decide(self, key):
+        act, weight, _ = self.buckets[key]
+        self.decision = Decision(act, weight, self.total_weight, len(self.voters), key == self.expected_key)
+        if not self.decision.agrees:
+            SERVER_LOG.info(f"Humans decided on {act}, which isn't what the instruction says")
+        return self.decision
+
+    # The answers so far, heaviest first, as [(action, weight, voters)]
+    def standings(self):
+        return sorted((tuple(bucket) for bucket in self.buckets.values()), key=lambda bucket: -bucket[1])
+
+    # Voters who answered something else than what was decided
+    def dissenters(self):
+        if self.decision is None:
+            return []
+        winner = self.decision.action.key()
+        return [voter for key, bucket in self.buckets.items() if key != winner for voter in bucket[2]]
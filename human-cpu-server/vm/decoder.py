@@ -0,0 +1,34 @@
+from log import VM_LOG
+from instruction import parse_instruction
+
+class DecodeCache:
+    # The code is read-only, so every ip only has to be decoded once. The
+    # cache is shared by all cores running the same code, and the only thing
+    # left to do per fetch is binding the instruction to the requesting core
+    def __init__(self, code):
+        self.code = code
+        self.decoded = {} # ip: (req_addr -> Instruction, length) or None
+
+    def decode(self, ip):
+        try:
+            return self.decoded[ip]
+        except KeyError:
+            pass
+
+        res = parse_instruction(self.code, ip)
+        self.decoded[ip] = res
+        return res
+
+    # Has to be called if the code is changed
+    def invalidate(self):
+        self.decoded = {}
+
+    def predecode(self):
+        # Linear sweep over the program. Bytes that don't decode (data, or
+        # instructions the VM doesn't know yet) are skipped one at a time
+        ip = 0
+        while ip < len(self.code):
+            res = self.decode(ip)
+            ip += 1 if res is None else res[1]
+
+        VM_LOG.info(f"Predecoded {sum(res is not None for res in self.decoded.values())} instructions")
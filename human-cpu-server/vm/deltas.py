@@ -0,0 +1,113 @@
+from bisect import bisect_right
+
+from regfile import REGISTER_NAMES
+
+class CoreDelta:
+    __slots__ = ("regs", "ram", "handlers", "idle", "created", "removed")
+
+    def __init__(self):
+        self.regs = {} # name: value
+        self.ram = {} # addr: value
+        self.handlers = {} # atom: (expected-content-len, store-content-addr, run-ip)
+        self.idle = None # new idle state, None if unchanged
+        self.created = False
+        self.removed = False
+
+class DeltaBuffer:
+    # Collects what actions changed, per core, until it is taken by whoever
+    # broadcasts it. Writing the same register or cell twice only keeps the
+    # last value, so the size of a delta only depends on what was changed
+    def __init__(self):
+        self.cores = {} # addr: CoreDelta
+        self.printed = []
+
+    def core(self, addr):
+        delta = self.cores.get(addr)
+        if delta is None:
+            delta = self.cores[addr] = CoreDelta()
+        return delta
+
+    def regs(self, core, names):
+        delta = self.core(core.address).regs
+        for name in names:
+            delta[name] = core.registers[name]
+
+    def ram(self, core, addrs):
+        delta = self.core(core.address).ram
+        for addr in addrs:
+            delta[addr] = core.ram[addr]
+
+    def handler(self, core, atom):
+        self.core(core.address).handlers[atom] = core.handlers[atom]
+
+    def idle(self, core):
+        self.core(core.address).idle = core.idle
+
+    # core has run the handler for atom with a message of content
+    def handled(self, core, atom, content):
+        expected_content_len, content_addr, run_ip = core.handlers[atom]
+        self.ram(core, range(content_addr, content_addr + min(len(content), expected_content_len)))
+        self.regs(core, ["ip"])
+        self.idle(core)
+
+    def created(self, core):
+        delta = self.core(core.address)
+        delta.created = True
+        delta.removed = False
+        self.regs(core, REGISTER_NAMES)
+
+    def removed(self, addr):
+        delta = self.cores[addr] = CoreDelta()
+        delta.removed = True
+
+    def print(self, msg):
+        self.printed.append(msg)
+
+    def take(self):
+        cores, self.cores = self.cores, {}
+        printed, self.printed = self.printed, []
+        return cores, printed
+
+class Subscription:
+    # What one client is looking at: the registers and handlers of some
+    # cores, and some ranges of their RAM, as [start, end) pairs
+    def __init__(self):
+        self.ranges = {} # core addr: (sorted starts, ends), ranges merged
+
+    def watch(self, addr, ranges):
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            elif start < end:
+                merged.append([start, end])
+        self.ranges[addr] = ([start for start, _ in merged], [end for _, end in merged])
+
+    def unwatch(self, addr):
+        self.ranges.pop(addr, None)
+
+    def sees(self, core_addr, addr):
+        starts, ends = self.ranges[core_addr]
+        i = bisect_right(starts, addr) - 1
+        return i >= 0 and addr < ends[i]
+
+    # The part of a CoreDelta this client cares about as JSON, or None if
+    # there isn't any
+    def filter(self, core_addr, delta):
+        res = {}
+        if delta.created:
+            res["created"] = True
+        if delta.removed:
+            res["removed"] = True
+        if delta.idle is not None:
+            res["idle"] = delta.idle
+        if delta.regs:
+            res["regs"] = {name: hex(val) for name, val in delta.regs.items()}
+        if delta.handlers:
+            res["handlers"] = {hex(atom): [hex(val) for val in handler] for atom, handler in delta.handlers.items()}
+
+        ram = {hex(addr): hex(val) for addr, val in delta.ram.items() if self.sees(core_addr, addr)}
+        if ram:
+            res["ram"] = ram
+
+        return res or None
@@ -1,9 +1,12 @@
+import operator
 import random
 import struct
 from abc import ABC, abstractmethod
 from enum import Enum
 
 import action
+from ram import U64_MASK
+from regfile import IP_SLOT, REGISTER_SLOTS
 
 class Argument(ABC):
     @abstractmethod
@@ -14,6 +17,17 @@ class Argument(ABC):
     def get_desc(self):
         pass
 
+    # Gives a function reading the value straight out of a register file
+    @abstractmethod
+    def make_getter(self):
+        pass
+
+    # Gives a python expression for the value, for the instruction at ip.
+    # The register file is called r
+    @abstractmethod
+    def make_source(self, ip):
+        pass
+
 class Constant(Argument):
     def __init__(self, val):
         self.val = val
@@ -21,27 +35,47 @@ class Constant(Argument):
     def get_value(self, _cpu):
         return self.val
 
+    def make_getter(self):
+        val = self.val
+        return lambda _regfile: val
+
+    def make_source(self, ip):
+        return hex(self.val)
+
     def get_desc(self):
         return hex(self.val)
 
 class Register(Argument):
     def __init__(self, reg):
         self.reg = reg
+        self.slot = REGISTER_SLOTS[reg]
 
     def get_value(self, cpu):
-        return cpu.registers[self.reg]
+        return cpu.regfile[self.slot]
+
+    def make_getter(self):
+        return operator.itemgetter(self.slot)
+
+    def make_source(self, ip):
+        # $ip always contains the address of the instruction being run
+        if self.slot == IP_SLOT:
+            return hex(ip)
+        return f"r[{self.slot}]"
 
     def get_desc(self):
         return f"register ${self.reg}"
 
-def parse_constant(bytestr):
-    if len(bytestr) < 9:
+# All parsers take the whole code buffer and the offset to start parsing at,
+# so that nothing has to be sliced (and copied) while decoding
+
+def parse_constant(code, at):
+    if len(code) - at < 9:
         return None
 
-    if bytestr[0] != 0x4e:
+    if code[at] != 0x4e:
         return None
 
-    return Constant(*struct.unpack("Q", bytestr[1:9])), 9
+    return Constant(*struct.unpack_from("Q", code, at + 1)), 9
 
 REGISTERS = {
     0x40: "ip",
@@ -52,39 +86,73 @@ REGISTERS = {
     0x7a: "rz",
     0x58: "brian",
 }
-def parse_register(bytestr):
-    if len(bytestr) < 1:
+# Registers can't be changed, so every decoded instruction shares these
+REGISTER_ARGUMENTS = {code: Register(name) for code, name in REGISTERS.items()}
+
+def parse_register(code, at):
+    if len(code) - at < 1:
         return None
 
-    if bytestr[0] in REGISTERS:
-        return Register(REGISTERS[bytestr[0]]), 1
+    if code[at] in REGISTER_ARGUMENTS:
+        return REGISTER_ARGUMENTS[code[at]], 1
 
     return None
 
 def parser_any(*parsers):
-    def parse(bytestr):
+    def parse(code, at=0):
+        if at < 0:
+            return None
+
         for parser in parsers:
-            res = parser(bytestr)
+            res = parser(code, at)
             if res is not None:
                 return res
         return None
 
     return parse
 
-parse_argument = parser_any(parse_register, parse_constant)
+# Like parser_any, but picks the parser with a single lookup of the first
+# byte instead of trying them one after another. Every parser has to say
+# which first bytes it handles in parsers_by_tag
+def parser_dispatch(*parsers):
+    parsers_by_tag = {}
+    for parser in parsers:
+        parsers_by_tag.update(parser.parsers_by_tag)
+
+    table = [None] * 256
+    for tag, parser in parsers_by_tag.items():
+        table[tag] = parser
+
+    def parse(code, at=0):
+        if at < 0 or len(code) - at < 1:
+            return None
+
+        parser = table[code[at]]
+        if parser is None:
+            return None
+        return parser(code, at)
+
+    parse.parsers_by_tag = parsers_by_tag
+    return parse
+
+parse_register.parsers_by_tag = {tag: parse_register for tag in REGISTERS}
+parse_constant.parsers_by_tag = {0x4e: parse_constant}
+
+parse_argument = parser_dispatch(parse_register, parse_constant)
 
 
 def make_instparser(cls, instruction_tag, n_args):
-    def parse(bytestr):
-        if len(bytestr) < 1:
+    def parse(code, at=0):
+        if len(code) - at < 1:
             return None
-        if bytestr[0] != instruction_tag:
+        if code[at] != instruction_tag:
             return None
 
+        start = at
         args = []
-        at = 1
+        at += 1
         for i in range(n_args):
-            res = parse_argument(bytestr[at:])
+            res = parse_argument(code, at)
             if res is None:
                 return None
             arg, delta = res
@@ -94,11 +162,14 @@ def make_instparser(cls, instruction_tag, n_args):
         def make_instance(req_addr):
             return cls(req_addr, *args)
 
-        return make_instance
+        return make_instance, at - start
 
+    parse.parsers_by_tag = {instruction_tag: parse}
     return parse
 
 class Instruction(ABC):
+    # Instructions coming from CPU.query_instructions also get ip and length,
+    # saying where in the code they are
     def __init__(self, req_addr):
         self.req_addr = req_addr
 
@@ -111,11 +182,32 @@ class Instruction(ABC):
     def fake_action(self, cpu):
         pass
 
+    # Gives a function cpu -> None performing this instruction directly on a
+    # core, without going through an Action. None if the instruction has
+    # effects outside of the core, and has to go through fake_action
+    def make_executor(self):
+        return None
+
+    # Like make_executor, but gives python source for the instruction at ip,
+    # for compiling many instructions into one function. The register file
+    # is called r, the RAM ram and the address of the core addr
+    def make_source(self, ip):
+        return None
+
+    # Does running this instruction change $ip
+    def writes_ip(self):
+        return False
+
+    # Can the executor or source of this instruction raise
+    def may_raise(self):
+        return False
+
+    # Parses the instruction starting at code[at]
     # Gives either:
-    #   (Instruction, int) - The parsed instruction and how many bytes the instruction took
+    #   (req_addr -> Instruction, int) - A function making the parsed instruction for a core, and how many bytes the instruction took
     #   None - The instruction could not be parsed
     @abstractmethod
-    def parse(bytestr):
+    def parse(code, at=0):
         pass
 
 class Set(Instruction):
@@ -133,6 +225,21 @@ class Set(Instruction):
         val = self.val.get_value(cpu)
         return action.WriteToCPU(self.req_addr, new_ram={}, new_regs={self.reg.reg: val})
 
+    def make_executor(self):
+        slot = self.reg.slot
+        get_val = self.val.make_getter()
+
+        def execute(cpu):
+            regfile = cpu.regfile
+            regfile[slot] = get_val(regfile)
+        return execute
+
+    def make_source(self, ip):
+        return f"r[{self.reg.slot}] = {self.val.make_source(ip)}"
+
+    def writes_ip(self):
+        return self.reg.slot == IP_SLOT
+
     parse = make_instparser(lambda *x: Set(*x), 0x53, 2)
 
 class SetMem(Instruction):
@@ -149,6 +256,18 @@ class SetMem(Instruction):
         val = self.val.get_value(cpu)
         return action.WriteToCPU(self.req_addr, new_ram={addr: val}, new_regs={})
 
+    def make_executor(self):
+        get_addr = self.addr.make_getter()
+        get_val = self.val.make_getter()
+
+        def execute(cpu):
+            regfile = cpu.regfile
+            cpu.ram[get_addr(regfile)] = get_val(regfile)
+        return execute
+
+    def make_source(self, ip):
+        return f"ram[{self.addr.make_source(ip)}] = {self.val.make_source(ip)}"
+
     parse = make_instparser(lambda *x: SetMem(*x), 0x73, 2)
 
 class ReadMem(Instruction):
@@ -163,8 +282,23 @@ class ReadMem(Instruction):
         return f"Set {self.reg_res.get_desc()} to the value at RAM address {self.addr.get_desc()}"
 
     def fake_action(self, cpu):
-        val = cpu.ram[self.val.get_value(cpu)]
-        return action.WriteToCPU(self.req_addr, new_ram={}, new_regs={self.reg.reg: val})
+        val = cpu.ram[self.addr.get_value(cpu)]
+        return action.WriteToCPU(self.req_addr, new_ram={}, new_regs={self.reg_res.reg: val})
+
+    def make_executor(self):
+        slot = self.reg_res.slot
+        get_addr = self.addr.make_getter()
+
+        def execute(cpu):
+            regfile = cpu.regfile
+            regfile[slot] = cpu.ram[get_addr(regfile)]
+        return execute
+
+    def make_source(self, ip):
+        return f"r[{self.reg_res.slot}] = ram[{self.addr.make_source(ip)}]"
+
+    def writes_ip(self):
+        return self.reg_res.slot == IP_SLOT
 
     parse = make_instparser(lambda *x: ReadMem(*x), 0x52, 2)
 
@@ -182,7 +316,7 @@ class ArithmeticVariant(Enum):
     def get_desc(self, a, b):
         if self == ArithmeticVariant.ADD: return f"{a} + {b}"
         if self == ArithmeticVariant.SUB: return f"{a} - {b}"
-        if self == ArithmeticVariant.MUL: return f"{a} + {b}"
+        if self == ArithmeticVariant.MUL: return f"{a} * {b}"
         if self == ArithmeticVariant.DIV: return f"{a} / {b} (integer division rounding down)"
 
         if self == ArithmeticVariant.LT: return f"1 if {a} < {b}, 0 otherwise"
@@ -192,17 +326,34 @@ class ArithmeticVariant(Enum):
         if self == ArithmeticVariant.GE: return f"1 if {a} &ge; {b}, 0 otherwise"
 
     def perform(self, a, b):
-        if self == ArithmeticVariant.ADD: return a + b
-        if self == ArithmeticVariant.SUB: return a - b
-        if self == ArithmeticVariant.MUL: return a + b
-        if self == ArithmeticVariant.DIV: return a // b
-
-        if self == ArithmeticVariant.LT: return a < b
-        if self == ArithmeticVariant.LE: return a <= b
-        if self == ArithmeticVariant.EQ: return a == b
-        if self == ArithmeticVariant.GT: return a > b
-        if self == ArithmeticVariant.GE: return a >= b
+        return ARITHMETIC_OPERATIONS[self](a, b)
+
+# Registers are u64s like the RAM, so results wrap around
+ARITHMETIC_OPERATIONS = {
+    ArithmeticVariant.ADD: lambda a, b: (a + b) & U64_MASK,
+    ArithmeticVariant.SUB: lambda a, b: (a - b) & U64_MASK,
+    ArithmeticVariant.MUL: lambda a, b: (a * b) & U64_MASK,
+    ArithmeticVariant.DIV: operator.floordiv,
+
+    ArithmeticVariant.LT: lambda a, b: int(a < b),
+    ArithmeticVariant.LE: lambda a, b: int(a <= b),
+    ArithmeticVariant.EQ: lambda a, b: int(a == b),
+    ArithmeticVariant.GT: lambda a, b: int(a > b),
+    ArithmeticVariant.GE: lambda a, b: int(a >= b),
+}
 
+ARITHMETIC_SOURCES = {
+    ArithmeticVariant.ADD: "({} + {}) & 0xffffffffffffffff",
+    ArithmeticVariant.SUB: "({} - {}) & 0xffffffffffffffff",
+    ArithmeticVariant.MUL: "({} * {}) & 0xffffffffffffffff",
+    ArithmeticVariant.DIV: "{} // {}",
+
+    ArithmeticVariant.LT: "(1 if {} < {} else 0)",
+    ArithmeticVariant.LE: "(1 if {} <= {} else 0)",
+    ArithmeticVariant.EQ: "(1 if {} == {} else 0)",
+    ArithmeticVariant.GT: "(1 if {} > {} else 0)",
+    ArithmeticVariant.GE: "(1 if {} >= {} else 0)",
+}
 
 class Arithmetic(Instruction):
     def __init__(self, variant, req_addr, output, arg1, arg2):
@@ -225,6 +376,28 @@ class Arithmetic(Instruction):
 
         return action.WriteToCPU(self.req_addr, new_ram={}, new_regs={self.output.reg: res})
 
+    def make_executor(self):
+        slot = self.output.slot
+        get_v1 = self.arg1.make_getter()
+        get_v2 = self.arg2.make_getter()
+        perform = ARITHMETIC_OPERATIONS[self.variant]
+
+        def execute(cpu):
+            regfile = cpu.regfile
+            regfile[slot] = perform(get_v1(regfile), get_v2(regfile))
+        return execute
+
+    def make_source(self, ip):
+        res = ARITHMETIC_SOURCES[self.variant].format(self.arg1.make_source(ip), self.arg2.make_source(ip))
+        return f"r[{self.output.slot}] = {res}"
+
+    def writes_ip(self):
+        return self.output.slot == IP_SLOT
+
+    # Division by zero
+    def may_raise(self):
+        return self.variant == ArithmeticVariant.DIV
+
     def make_parse(variant):
         return make_instparser(lambda *x: Arithmetic(variant, *x), variant.value, 3)
 
@@ -238,7 +411,7 @@ class Arithmetic(Instruction):
     parse_gt = make_parse(ArithmeticVariant.GT)
     parse_ge = make_parse(ArithmeticVariant.GE)
 
-    parse = parser_any(parse_add, parse_sub, parse_mul, parse_div, parse_lt, parse_le, parse_eq, parse_gt, parse_ge)
+    parse = parser_dispatch(parse_add, parse_sub, parse_mul, parse_div, parse_lt, parse_le, parse_eq, parse_gt, parse_ge)
 
 
 class SendMessage(Instruction):
@@ -262,7 +435,7 @@ class SendMessage(Instruction):
         content_addr = self.content_addr.get_value(cpu)
 
         assert(content_len <= 0x8)
-        content = [cpu.ram[i] for i in range(content_addr, content_addr + content_len)]
+        content = cpu.ram.read_range(content_addr, content_len)
 
         return action.SendMessage(receiver, atom, content)
 
@@ -292,6 +465,18 @@ class MakeHandler(Instruction):
 
     parse = make_instparser(lambda *x: MakeHandler(*x), 0x21, 4)
 
+class Idle(Instruction):
+    def __init__(self, req_addr):
+        super().__init__(req_addr)
+
+    def get_desc(self):
+        return "Wait until a message this core has a handler for arrives"
+
+    def fake_action(self, cpu):
+        return action.GoIdle(self.req_addr)
+
+    parse = make_instparser(lambda *x: Idle(*x), 0x49, 0)
+
 class Selfaddr(Instruction):
     def __init__(self, req_addr, output):
         super().__init__(req_addr)
@@ -305,6 +490,19 @@ class Selfaddr(Instruction):
     def fake_action(self, cpu):
         return action.WriteToCPU(self.req_addr, new_ram={}, new_regs={self.output.reg: self.req_addr})
 
+    def make_executor(self):
+        slot = self.output.slot
+
+        def execute(cpu):
+            cpu.regfile[slot] = cpu.address
+        return execute
+
+    def make_source(self, ip):
+        return f"r[{self.output.slot}] = addr"
+
+    def writes_ip(self):
+        return self.output.slot == IP_SLOT
+
     parse = make_instparser(lambda *x: Selfaddr(*x), 0x3f, 1)
 
 class CreateActor(Instruction):
@@ -323,13 +521,38 @@ class CreateActor(Instruction):
 
     parse = make_instparser(lambda *x: CreateActor(*x), 0x7d, 1)
 
-parse_instruction = parser_any(
+# Longest message Print can print, the length comes from the program
+MAX_PRINT_LEN = 0x100
+
+class Print(Instruction):
+    def __init__(self, req_addr, content_len, content_addr):
+        super().__init__(req_addr)
+
+        self.content_len = content_len
+        self.content_addr = content_addr
+
+    def get_desc(self):
+        return f"Print the {self.content_len.get_desc()} values in RAM starting at {self.content_addr.get_desc()}"
+
+    def fake_action(self, cpu):
+        content_len = self.content_len.get_value(cpu)
+        content_addr = self.content_addr.get_value(cpu)
+
+        if content_len > MAX_PRINT_LEN:
+            raise ValueError(f"Can't print {content_len} values, at most {MAX_PRINT_LEN}")
+        return action.Print(cpu.ram.read_range(content_addr, content_len))
+
+    parse = make_instparser(lambda *x: Print(*x), 0x23, 2)
+
+parse_instruction = parser_dispatch(
     Set.parse,
     SetMem.parse,
     ReadMem.parse,
     Arithmetic.parse,
+    Idle.parse,
     SendMessage.parse,
     MakeHandler.parse,
     Selfaddr.parse,
     CreateActor.parse,
+    Print.parse,
 )
@@ -0,0 +1,248 @@
+import mmap
+import os
+import struct
+import threading
+from collections import deque
+
+import action
+from log import VM_LOG
+from regfile import REGISTER_NAMES, REGISTER_SLOTS
+from snapshot import Reader, Writer
+from vm import VirtualMachine
+
+# Records that pile up before they are written and synced by themselves
+SYNC_BATCH = 1024
+
+LENGTH = struct.Struct("<I")
+
+# Record kinds
+START = 0 # the VM the journal starts from
+COMPLETED = 1 # VirtualMachine.complete
+
+# The journal is a file of records, every record is a u32 length followed
+# by that many bytes:
+#   START:     kind u8, seed int, policy bytes, inherit_ram u8, code bytes
+#   COMPLETED: kind u8, req_addr int, ip int, length int, action
+# with ints and bytes as in snapshot.py. Actions are a kind u8 (index in
+# ACTION_ENCODINGS) followed by their fields.
+#
+# Replaying a journal from the start gives the same VM, as the seed gives
+# the first core the same address and every action has whatever random
+# address it used (for CreateActor) in it
+
+def write_ints(w, vals):
+    w.u64(len(vals))
+    for val in vals:
+        w.int(val)
+
+def read_ints(r):
+    return [r.int() for _ in range(r.u64())]
+
+def encode_write(w, act):
+    w.int(act.cpu_addr)
+    w.u64(len(act.new_ram))
+    for addr, val in act.new_ram.items():
+        w.int(addr)
+        w.int(val)
+    w.u64(len(act.new_regs))
+    for reg, val in act.new_regs.items():
+        w.u8(REGISTER_SLOTS[reg])
+        w.int(val)
+
+def decode_write(r):
+    cpu_addr = r.int()
+    new_ram = {}
+    for _ in range(r.u64()):
+        addr = r.int()
+        new_ram[addr] = r.int()
+    new_regs = {}
+    for _ in range(r.u64()):
+        reg = REGISTER_NAMES[r.u8()]
+        new_regs[reg] = r.int()
+    return action.WriteToCPU(cpu_addr, new_ram, new_regs)
+
+def encode_handler(w, act):
+    for val in [act.cpu_addr, act.atom, act.n_args, act.write_args_to, act.run_ip]:
+        w.int(val)
+
+def decode_handler(r):
+    return action.MakeNewHandler(r.int(), r.int(), r.int(), r.int(), r.int())
+
+def encode_send(w, act):
+    w.int(act.receiver)
+    w.int(act.atom)
+    write_ints(w, act.content)
+
+def decode_send(r):
+    return action.SendMessage(r.int(), r.int(), read_ints(r))
+
+def encode_idle(w, act):
+    w.int(act.cpu_addr)
+
+def decode_idle(r):
+    return action.GoIdle(r.int())
+
+def encode_print(w, act):
+    write_ints(w, act.msg)
+
+def decode_print(r):
+    return action.Print(read_ints(r))
+
+def encode_create(w, act):
+    for val in [act.new_actor_addr, act.run_ip, act.creator_addr]:
+        w.int(val)
+
+def decode_create(r):
+    return action.CreateActor(r.int(), r.int(), r.int())
+
+ACTION_ENCODINGS = [
+    (action.WriteToCPU, encode_write, decode_write),
+    (action.MakeNewHandler, encode_handler, decode_handler),
+    (action.SendMessage, encode_send, decode_send),
+    (action.GoIdle, encode_idle, decode_idle),
+    (action.Print, encode_print, decode_print),
+    (action.CreateActor, encode_create, decode_create),
+]
+ACTION_TAGS = {kind: (tag, encode) for tag, (kind, encode, _) in enumerate(ACTION_ENCODINGS)}
+
+def encode_action(w, act):
+    tag, encode = ACTION_TAGS[type(act)]
+    w.u8(tag)
+    encode(w, act)
+
+def decode_action(r):
+    return ACTION_ENCODINGS[r.u8()][2](r)
+
+# Gives (kind, Reader positioned after the kind) for every record in the
+# journal, from the start. A record cut short by a crash ends the journal.
+# Returns the offset just past the last complete record
+def read_records(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return 0
+
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    at = 0
+    while at + LENGTH.size <= len(data):
+        length = LENGTH.unpack_from(data, at)[0]
+        if at + LENGTH.size + length > len(data):
+            break
+
+        r = Reader(data)
+        r.at = at + LENGTH.size + 1
+        yield data[at + LENGTH.size], r
+        at += LENGTH.size + length
+
+    if at < len(data):
+        VM_LOG.warn(f"Journal {path} ends in the middle of a record, ignoring it")
+    return at
+
+# (number of COMPLETED records, offset just past the last complete record)
+def scan_records(path):
+    records = read_records(path)
+    count = 0
+    while True:
+        try:
+            kind, _ = next(records)
+        except StopIteration as stop:
+            return count, stop.value
+        count += kind == COMPLETED
+
+class Journal:
+    # Appends a record for every completed instruction of a VM to a file.
+    # Records are kept in memory until sync() writes and fsyncs all of them
+    # at once, which happens by itself every batch records unless batch is
+    # None. sync() can be called from another thread than the one appending
+    #
+    # count is the number of COMPLETED records, also in the file from before
+    def __init__(self, path, batch=SYNC_BATCH):
+        self.path = path
+        self.batch = batch
+        self.count, end = scan_records(path)
+
+        # Anything appended after a record cut short by a crash would be
+        # read as part of it, so it goes first
+        if os.path.exists(path) and os.path.getsize(path) > end:
+            VM_LOG.warn(f"Cutting journal {path} off after its last complete record")
+            os.truncate(path, end)
+
+        self.file = open(path, "ab")
+        self.pending = deque() # encoded records, appended from one thread and taken by sync
+        self.lock = threading.Lock()
+
+    def append(self, w):
+        self.pending.append(LENGTH.pack(len(w.buf)) + w.buf)
+        if self.batch is not None and len(self.pending) >= self.batch:
+            self.sync()
+
+    def start(self, vm):
+        w = Writer()
+        w.u8(START)
+        w.int(vm.seed)
+        w.bytes(vm.scheduler.policy.encode())
+        w.u8(vm.inherit_ram)
+        w.bytes(vm.code)
+        self.append(w)
+
+    def completed(self, req_addr, ip, length, act):
+        w = Writer()
+        w.u8(COMPLETED)
+        w.int(req_addr)
+        w.int(ip)
+        w.int(length)
+        encode_action(w, act)
+        self.append(w)
+        self.count += 1
+
+    def sync(self):
+        with self.lock:
+            records = []
+            while self.pending:
+                records.append(self.pending.popleft())
+            if not records:
+                return
+
+            self.file.write(b"".join(records))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+# Rebuilds the VM as it was after the first until completed instructions
+# in the journal (all of them with until=None). With a SnapshotStore, it
+# starts from the newest snapshot that isn't past until, taken with the
+# journal position as extra, and only replays the rest of the journal.
+# Gives (VirtualMachine, number of completed instructions it is at)
+def replay(path, store=None, until=None):
+    vm = None
+    position = 0
+
+    if store is not None:
+        for seq in reversed(store.snapshots()):
+            if until is None or store.extra(seq) <= until:
+                vm, position = store.restore(seq)
+                break
+
+    skip = position
+    for kind, r in read_records(path):
+        if kind == START:
+            if vm is None:
+                seed = r.int()
+                policy = r.bytes().decode()
+                inherit_ram = bool(r.u8())
+                vm = VirtualMachine(r.bytes(), inherit_ram=inherit_ram, policy=policy, seed=seed)
+            continue
+
+        if skip > 0:
+            skip -= 1
+            continue
+        if until is not None and position >= until:
+            break
+
+        vm.complete(r.int(), r.int(), r.int(), decode_action(r))
+        position += 1
+
+    return vm, position
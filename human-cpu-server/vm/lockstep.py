@@ -0,0 +1,173 @@
+import numpy as np
+
+from autopilot import Autopilot, QUANTUM
+from instruction import Arithmetic, ArithmeticVariant, Constant, Set
+from log import VM_LOG
+from regfile import IP_SLOT, N_REGISTERS
+
+# Groups smaller than this aren't worth loading into arrays
+MIN_GROUP = 16
+
+def vector_arithmetic(variant, a, b):
+    # Gives (result, lanes where python would raise instead). Registers
+    # wrap around like u64s do, so only division by zero is different
+    if variant == ArithmeticVariant.DIV:
+        return a // np.where(b == 0, np.uint64(1), b), b == 0
+
+    if variant == ArithmeticVariant.ADD: res = a + b
+    if variant == ArithmeticVariant.SUB: res = a - b
+    if variant == ArithmeticVariant.MUL: res = a * b
+    if variant == ArithmeticVariant.LT: res = a < b
+    if variant == ArithmeticVariant.LE: res = a <= b
+    if variant == ArithmeticVariant.EQ: res = a == b
+    if variant == ArithmeticVariant.GT: res = a > b
+    if variant == ArithmeticVariant.GE: res = a >= b
+    return np.asarray(res).astype(np.uint64), np.zeros(np.shape(res), dtype=bool)
+
+class LockstepEngine:
+    # Runs many actors that are at the same $ip in the same code together,
+    # SIMD style. The registers of such a group are loaded into a
+    # (register, actor) array, and Set and Arithmetic instructions are run on
+    # the whole group at once. Everything else, groups that are too small and
+    # actors whose $ip went somewhere else run one by one on the autopilot.
+    #
+    # The arrays hold u64s, like the registers. Whenever an instruction
+    # would divide by zero it is run one by one instead, so the results are
+    # always the same as on the autopilot
+    def __init__(self, vm, min_group=MIN_GROUP):
+        self.vm = vm
+        self.min_group = min_group
+        self.autopilot = Autopilot(vm)
+
+        self.vector_ops = {} # ip: (Instruction, length), or None if it can't be run in lockstep
+
+    def vector_op(self, ip):
+        try:
+            return self.vector_ops[ip]
+        except KeyError:
+            pass
+
+        decoded = self.vm.decoder.decode(ip)
+        res = None
+        if decoded is not None:
+            inst_init, length = decoded
+            inst = inst_init(0)
+            if isinstance(inst, (Set, Arithmetic)):
+                res = (inst, length)
+
+        self.vector_ops[ip] = res
+        return res
+
+    def run(self, steps=None, quantum=QUANTUM):
+        self.autopilot.check_code()
+
+        executed = 0
+        while steps is None or executed < steps:
+            cores = self.vm.scheduler.pick()
+            if not cores:
+                VM_LOG.info("Lockstep: no runnable cores left")
+                break
+
+            by_ip = {}
+            for core in cores:
+                by_ip.setdefault(core.regfile[IP_SLOT], []).append(core)
+
+            for ip, group in by_ip.items():
+                left = None if steps is None else steps - executed
+                if left is not None and left <= 0:
+                    break
+
+                if len(group) >= self.min_group and self.vector_op(ip) is not None \
+                        and (left is None or left >= len(group)):
+                    rounds = quantum if left is None else min(quantum, left // len(group))
+                    executed += self.run_group(ip, group, rounds)
+                    continue
+
+                for core in group:
+                    budget = quantum if steps is None else min(quantum, steps - executed)
+                    if budget <= 0:
+                        break
+                    executed += self.autopilot.run_core(core, budget)
+
+        return executed
+
+    def load(self, group):
+        fits = []
+        rest = []
+        for core in group:
+            if all(0 <= val < 1 << 64 for val in core.regfile):
+                fits.append(core)
+            else:
+                rest.append(core)
+
+        regs = np.array([core.regfile for core in fits], dtype=np.uint64).reshape(len(fits), N_REGISTERS)
+        return np.ascontiguousarray(regs.T), fits, rest
+
+    def operand(self, arg, regs, ip):
+        if isinstance(arg, Constant):
+            return np.uint64(arg.val)
+        if arg.slot == IP_SLOT:
+            return np.uint64(ip)
+        return regs[arg.slot]
+
+    # Runs the group for at most rounds instructions, gives how many
+    # instructions were run in total
+    def run_group(self, ip, group, rounds):
+        regs, cores, rest = self.load(group)
+        executed = 0
+        for core in rest:
+            executed += self.autopilot.run_core(core, 1)
+
+        n = len(cores)
+        if n == 0:
+            return executed
+
+        n_rounds = 0
+        fallback = False
+        diverged = False
+        with np.errstate(all="ignore"):
+            while n_rounds < rounds:
+                op = self.vector_op(ip)
+                if op is None:
+                    break
+                inst, length = op
+
+                if isinstance(inst, Set):
+                    out = inst.reg.slot
+                    res = self.operand(inst.val, regs, ip)
+                else:
+                    out = inst.output.slot
+                    a = self.operand(inst.arg1, regs, ip)
+                    b = self.operand(inst.arg2, regs, ip)
+                    res, bad = vector_arithmetic(inst.variant, a, b)
+                    if np.any(bad):
+                        fallback = True
+                        break
+
+                regs[out] = res
+                n_rounds += 1
+
+                if out != IP_SLOT:
+                    ip += length
+                    continue
+
+                ips = regs[IP_SLOT]
+                ips[ips == ip] = ip + length
+                if np.any(ips != ips[0]):
+                    diverged = True
+                    break
+                ip = int(ips[0])
+
+        if not diverged:
+            regs[IP_SLOT] = ip
+
+        for core, regfile in zip(cores, regs.T.tolist()):
+            core.regfile[:] = regfile
+        executed += n_rounds * n
+
+        for core in cores:
+            if fallback and n_rounds < rounds:
+                executed += self.autopilot.run_core(core, 1)
+            self.vm.core_changed(core)
+
+        return executed
@@ -8,3 +8,5 @@ CPU_LOG = logging.getLogger("CPU")
 
 ACTION_LOG = logging.getLogger("Action")
 INSTRUCTION_LOG = logging.getLogger("Instruction")
+
+SERVER_LOG = logging.getLogger("Server")
@@ -0,0 +1,37 @@
+from collections import deque
+
+MAILBOX_CAPACITY = 64
+
+class Mailbox:
+    # Bounded FIFO of (atom, content) messages that have arrived at an actor
+    # but haven't been handled yet. Messages arriving at a full mailbox are
+    # dropped and counted
+    __slots__ = ("messages", "capacity", "received", "dropped")
+
+    def __init__(self, capacity=MAILBOX_CAPACITY):
+        self.messages = deque()
+        self.capacity = capacity
+
+        self.received = 0
+        self.dropped = 0
+
+    def push(self, atom, content):
+        self.received += 1
+        if len(self.messages) >= self.capacity:
+            self.dropped += 1
+            return False
+
+        self.messages.append((atom, content))
+        return True
+
+    # Takes out the oldest message that has a handler. Messages without a
+    # handler are left in the mailbox, in case a handler for them is made later
+    def take_matching(self, handlers):
+        for i, (atom, content) in enumerate(self.messages):
+            if atom in handlers:
+                del self.messages[i]
+                return atom, content
+        return None
+
+    def __len__(self):
+        return len(self.messages)
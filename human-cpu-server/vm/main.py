@@ -1,4 +1,9 @@
+import argparse
+import logging
+import time
+
 import vm
+from autopilot import Autopilot
 
 def display_instinfo(code):
     print("\n"*3)
@@ -11,33 +16,64 @@ def display_instinfo(code):
         print("Instruction:", inst)
         print("Human description:", inst.get_desc())
 
-        action = inst.fake_action(virt.cores[0])
+        action = inst.fake_action(virt.cores.first())
 
-        print("Wanted action:", inst.fake_action(virt.cores[0]))
+        print("Wanted action:", inst.fake_action(virt.cores.first()))
         action.run(virt)
-        print("Afterwards:", virt.cores[0])
+        print("Afterwards:", virt.cores.first())
+
+def demo():
+    # Add ra 0x1234 0x4321
+    display_instinfo(b"+AN\x12\x34\x00\x00\x00\x00\x00\x00N\x43\x21\x00\x00\x00\x00\x00\x00")
+
+    # Set ra 0x5577
+    display_instinfo(b"SAN\x12\x34\x00\x00\x00\x00\x00\x00")
+
+    # Set-addr 0x100 0x5577
+    display_instinfo(b"sN\x00\x01\x00\x00\x00\x00\x00\x00N\x12\x34\x00\x00\x00\x00\x00\x00")
 
+    # Send-message ra 0x30 0x2 0x1000
+    display_instinfo(b"^AN\x30\x00\x00\x00\x00\x00\x00\x00N\x02\x00\x00\x00\x00\x00\x00\x00N\x00\x10\x00\x00\x00\x00\x00\x00")
 
+    # Make-handler ra 0x30 0x2 0x1000
+    display_instinfo(b"!AN\x30\x00\x00\x00\x00\x00\x00\x00N\x02\x00\x00\x00\x00\x00\x00\x00N\x00\x10\x00\x00\x00\x00\x00\x00")
 
-# Add ra 0x1234 0x4321
-display_instinfo(b"+AN\x12\x34\x00\x00\x00\x00\x00\x00N\x43\x21\x00\x00\x00\x00\x00\x00")
+    # Self-addr $brian
+    display_instinfo(b"?X")
 
-# Set ra 0x5577
-display_instinfo(b"SAN\x12\x34\x00\x00\x00\x00\x00\x00")
+    # Create-actor $ip
+    display_instinfo(b"}@")
 
-# Set-addr 0x100 0x5577
-display_instinfo(b"sN\x00\x01\x00\x00\x00\x00\x00\x00N\x12\x34\x00\x00\x00\x00\x00\x00")
+def run_autopilot(path, steps):
+    # Per-core and per-message logging would take most of the time
+    logging.disable(logging.INFO)
 
-# Send-message ra 0x30 0x2 0x1000
-display_instinfo(b"^AN\x30\x00\x00\x00\x00\x00\x00\x00N\x02\x00\x00\x00\x00\x00\x00\x00N\x00\x10\x00\x00\x00\x00\x00\x00")
+    with open(path, "rb") as f:
+        code = f.read()
 
-# Make-handler ra 0x30 0x2 0x1000
-display_instinfo(b"!AN\x30\x00\x00\x00\x00\x00\x00\x00N\x02\x00\x00\x00\x00\x00\x00\x00N\x00\x10\x00\x00\x00\x00\x00\x00")
+    virt = vm.VirtualMachine(code, predecode=True)
+    autopilot = Autopilot(virt)
 
-# Self-addr $brian
-display_instinfo(b"?X")
+    start = time.perf_counter()
+    executed = autopilot.run(steps)
+    took = time.perf_counter() - start
 
-# Create-actor $ip
-display_instinfo(b"}@")
+    print(f"Ran {executed} instructions in {took:.3f}s ({executed / took:,.0f} instructions/s)")
+    print(f"{len(virt.cores)} cores, {virt.scheduler.n_runnable()} runnable, " +
+        f"{len(virt.scheduler.idle)} idle, {len(virt.scheduler.blocked)} blocked")
 
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Without a program, shows how some instructions are run")
+    argparser.add_argument("program", nargs="?", help="assembled program to run on autopilot")
+    limit = argparser.add_mutually_exclusive_group()
+    limit.add_argument("--steps", type=int, help="stop after this many instructions")
+    limit.add_argument("--until-idle", action="store_true", help="run until no core has anything left to run (default)")
+    args = argparser.parse_args()
 
+    if args.program is None:
+        if args.steps is not None or args.until_idle:
+            argparser.error("--steps and --until-idle need a program to run")
+        demo()
+    else:
+        # Without a step limit the autopilot stops once nothing is runnable
+        run_autopilot(args.program, None if args.until_idle else args.steps)
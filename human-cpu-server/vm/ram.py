@@ -0,0 +1,172 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS # u64s per page
+PAGE_MASK = PAGE_SIZE - 1
+
+U64_MASK = (1 << 64) - 1
+
+ZERO_PAGE = array("Q", [0]) * PAGE_SIZE
+
+class PagedRAM:
+    # Sparse u64 memory made of fixed-size pages of packed u64s. A page is
+    # only allocated when something is written to it, reading from a page
+    # that was never written to just gives zeros.
+    # Values are stored as u64s, so they wrap around like they would in
+    # real hardware
+    #
+    # snapshot() freezes the current pages into a layer shared between this
+    # RAM and the copy. Frozen pages are never written to, the first write
+    # to a page copies it into the writer's own pages.
+    #
+    # Every layer is kept more than twice as big as the one newer than it,
+    # by merging the newest layers into a new one as they grow. So there
+    # are at most about log2(pages) layers to look through, and a spawn only
+    # copies about as many pages as were written since the last one, not
+    # the whole RAM
+    #
+    # The numbers of all pages are also kept sorted, so finding the
+    # populated cells in a range or after an address only has to look at
+    # the pages that are actually there
+    __slots__ = ("pages", "layers", "index")
+
+    def __init__(self):
+        self.pages = {} # page number: array("Q"), owned by this RAM
+        self.layers = () # frozen {page number: array("Q")}, newest first
+        self.index = [] # sorted page numbers of pages and layers, None if it has to be rebuilt
+
+    def find_page(self, page_nr):
+        page = self.pages.get(page_nr)
+        if page is not None:
+            return page
+
+        for layer in self.layers:
+            page = layer.get(page_nr)
+            if page is not None:
+                return page
+        return None
+
+    def __getitem__(self, addr):
+        addr &= U64_MASK
+        page = self.find_page(addr >> PAGE_BITS)
+        if page is None:
+            return 0
+        return page[addr & PAGE_MASK]
+
+    def __setitem__(self, addr, val):
+        addr &= U64_MASK
+        val &= U64_MASK
+        page_nr = addr >> PAGE_BITS
+        page = self.pages.get(page_nr)
+        if page is None:
+            page = self.find_page(page_nr)
+            if page is None:
+                # Pages that aren't there already read as zeros
+                if val == 0:
+                    return
+                page = ZERO_PAGE[:]
+                if self.index is not None:
+                    insort(self.index, page_nr)
+            else:
+                if page[addr & PAGE_MASK] == val:
+                    return
+                # Frozen pages can also be read-only memoryviews, see snapshot.py
+                page = array("Q", page)
+            self.pages[page_nr] = page
+        page[addr & PAGE_MASK] = val
+
+        # A page that is back to all zeros is freed, unless it hides a
+        # frozen page with something in it
+        if val == 0 and page == ZERO_PAGE and not any(page_nr in layer for layer in self.layers):
+            del self.pages[page_nr]
+            if self.index is not None:
+                del self.index[bisect_left(self.index, page_nr)]
+
+    def snapshot(self):
+        if self.pages:
+            self.layers = (self.pages,) + self.layers
+            self.pages = {}
+
+        layers = self.layers
+        while len(layers) > 1 and 2 * len(layers[0]) >= len(layers[1]):
+            # Layers can be shared with other RAMs, so they are never changed
+            merged = dict(layers[1])
+            merged.update(layers[0])
+            layers = (merged,) + layers[2:]
+        self.layers = layers
+
+        copy = PagedRAM()
+        copy.layers = self.layers
+        copy.index = None # rebuilt by page_index() when it is needed
+        return copy
+
+    def page_index(self):
+        if self.index is None:
+            page_nrs = set(self.pages)
+            for layer in self.layers:
+                page_nrs.update(layer)
+            self.index = sorted(page_nrs)
+        return self.index
+
+    def read_range(self, start, length):
+        start &= U64_MASK
+        result = []
+        at = start
+        end = start + length
+        while at < end:
+            page_nr = at >> PAGE_BITS
+            offset = at & PAGE_MASK
+            n = min(PAGE_SIZE - offset, end - at)
+
+            page = self.find_page(page_nr & (U64_MASK >> PAGE_BITS))
+            if page is None:
+                result.extend([0] * n)
+            else:
+                result.extend(page[offset:offset + n])
+            at += n
+        return result
+
+    # All non-zero cells as (addr, value), in address order
+    def populated(self):
+        return self.populated_from(0)
+
+    # Non-zero cells at or after start, in address order
+    def populated_from(self, start):
+        return self.populated_range(start, 1 << 64)
+
+    # Non-zero cells before end, going down from end
+    def populated_before(self, end):
+        index = self.page_index()
+        for i in range(bisect_right(index, (end - 1) >> PAGE_BITS) - 1, -1, -1):
+            page_nr = index[i]
+            base = page_nr << PAGE_BITS
+            page = self.find_page(page_nr)
+            if page == ZERO_PAGE:
+                continue
+            for offset in range(min(end - base, PAGE_SIZE) - 1, -1, -1):
+                val = page[offset]
+                if val != 0:
+                    yield base + offset, val
+
+    # Non-zero cells in [start, end), in address order. Only the pages in
+    # the range are looked at, and pages that are all zeros are skipped
+    # with one comparison
+    def populated_range(self, start, end):
+        start &= U64_MASK
+        index = self.page_index()
+        first = bisect_left(index, start >> PAGE_BITS)
+        last = bisect_right(index, (end - 1) >> PAGE_BITS)
+        for i in range(first, last):
+            page_nr = index[i]
+            base = page_nr << PAGE_BITS
+            page = self.find_page(page_nr)
+            if page == ZERO_PAGE:
+                continue
+            for offset in range(max(start - base, 0), min(end - base, PAGE_SIZE)):
+                val = page[offset]
+                if val != 0:
+                    yield base + offset, val
+
+    def __repr__(self):
+        return repr(dict(self.populated()))
@@ -0,0 +1,46 @@
+# Every register gets a small slot index, so a core can keep its registers
+# in a plain fixed-size list instead of a dict keyed by the register name
+REGISTER_NAMES = ["ip", "ra", "rhen", "rx", "ry", "rz", "brian"]
+REGISTER_SLOTS = {name: slot for slot, name in enumerate(REGISTER_NAMES)}
+N_REGISTERS = len(REGISTER_NAMES)
+
+IP_SLOT = REGISTER_SLOTS["ip"]
+
+def new_regfile(ip):
+    regfile = [0] * N_REGISTERS
+    regfile[IP_SLOT] = ip
+    return regfile
+
+class NamedRegisters:
+    # Dict-like view of a register file, for code that wants to use names
+    __slots__ = ("regfile",)
+
+    def __init__(self, regfile):
+        self.regfile = regfile
+
+    def __getitem__(self, name):
+        return self.regfile[REGISTER_SLOTS[name]]
+
+    def __setitem__(self, name, val):
+        self.regfile[REGISTER_SLOTS[name]] = val
+
+    def __contains__(self, name):
+        return name in REGISTER_SLOTS
+
+    def __iter__(self):
+        return iter(REGISTER_NAMES)
+
+    def __len__(self):
+        return N_REGISTERS
+
+    def keys(self):
+        return list(REGISTER_NAMES)
+
+    def items(self):
+        return list(zip(REGISTER_NAMES, self.regfile))
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
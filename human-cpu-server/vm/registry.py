@@ -0,0 +1,30 @@
+class CoreRegistry:
+    # Keeps the cores keyed by their 64 bit address. dicts keep insertion
+    # order, so iterating gives the cores in the order they were created
+    def __init__(self):
+        self.by_addr = {} # addr: CPU
+
+    def add(self, core):
+        if core.address in self.by_addr:
+            return False
+
+        self.by_addr[core.address] = core
+        return True
+
+    def get(self, addr):
+        return self.by_addr.get(addr)
+
+    def remove(self, addr):
+        return self.by_addr.pop(addr, None)
+
+    def first(self):
+        return next(iter(self.by_addr.values()), None)
+
+    def __contains__(self, addr):
+        return addr in self.by_addr
+
+    def __iter__(self):
+        return iter(self.by_addr.values())
+
+    def __len__(self):
+        return len(self.by_addr)
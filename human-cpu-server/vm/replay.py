@@ -0,0 +1,28 @@
+import argparse
+import logging
+import time
+
+from journal import replay
+from snapshot import SnapshotStore
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Rebuild a VM from its journal, and optionally snapshots")
+    argparser.add_argument("journal")
+    argparser.add_argument("--snapshots", metavar="DIR", help="start from the newest snapshot here that isn't past --to")
+    argparser.add_argument("--to", type=int, metavar="N", help="stop after the first N completed instructions")
+    argparser.add_argument("--show", action="store_true", help="print every core afterwards")
+    args = argparser.parse_args()
+
+    # Per-core and per-message logging would take most of the time
+    logging.disable(logging.INFO)
+
+    store = None if args.snapshots is None else SnapshotStore(args.snapshots)
+
+    start = time.perf_counter()
+    virt, position = replay(args.journal, store, args.to)
+    took = time.perf_counter() - start
+
+    print(f"At instruction {position} with {len(virt.cores)} cores, took {took:.2f}s")
+    if args.show:
+        for core in virt.cores:
+            print(core)
@@ -0,0 +1,148 @@
+from itertools import islice
+
+from log import VM_LOG
+
+POLICIES = ["round-robin", "priority"]
+
+class ActorStats:
+    __slots__ = ("scheduled", "total_wait", "max_wait", "runnable_since")
+
+    def __init__(self, step):
+        self.scheduled = 0
+        self.total_wait = 0 # steps spent runnable without being scheduled
+        self.max_wait = 0
+        self.runnable_since = step
+
+    def __repr__(self):
+        return f"ActorStats(scheduled={self.scheduled}, total_wait={self.total_wait}, max_wait={self.max_wait})"
+
+class Scheduler:
+    # Keeps track of which cores are
+    #   runnable - have an instruction to run
+    #   idle     - waiting for a message
+    #   blocked  - $ip doesn't point to anything that decodes
+    # so that a step only has to look at the runnable ones.
+    #
+    # The VM has to call update() whenever something might have changed
+    # which of these a core is in
+    def __init__(self, policy="round-robin"):
+        assert(policy in POLICIES)
+        self.policy = policy
+
+        # priority: {addr: CPU}, dicts are used as ordered sets so that
+        # cores are picked round-robin within a priority
+        self.levels = {}
+        self.level_deletions = {} # priority: deletions from the level since it was last compacted
+        self.idle = set()
+        self.blocked = set()
+
+        self.priorities = {} # addr: priority, only used with the "priority" policy
+        self.where = {} # addr: the priority of the level the core is in, or "idle"/"blocked"
+        self.stats = {} # addr: ActorStats
+
+        self.step = 0
+
+    def add(self, core):
+        self.stats[core.address] = ActorStats(self.step)
+        self.update(core)
+
+    def remove(self, addr):
+        self.unlink(addr)
+        self.where.pop(addr, None)
+        self.priorities.pop(addr, None)
+        self.stats.pop(addr, None)
+
+    def set_priority(self, addr, priority):
+        self.priorities[addr] = priority
+        core = self.levels.get(self.where.get(addr), {}).get(addr)
+        if core is not None:
+            self.unlink(addr)
+            self.link_runnable(core)
+
+    def update(self, core):
+        state = core.state()
+        current = self.where.get(core.address)
+
+        if state == "runnable":
+            if current not in (None, "idle", "blocked"):
+                return
+            self.unlink(core.address)
+            self.stats[core.address].runnable_since = self.step
+            self.link_runnable(core)
+        else:
+            if current == state:
+                return
+            self.unlink(core.address)
+            getattr(self, state).add(core.address)
+            self.where[core.address] = state
+
+    def link_runnable(self, core):
+        priority = self.priorities.get(core.address, 0) if self.policy == "priority" else 0
+        self.levels.setdefault(priority, {})[core.address] = core
+        self.where[core.address] = priority
+
+    def unlink(self, addr):
+        current = self.where.get(addr)
+        if current == "idle":
+            self.idle.discard(addr)
+        elif current == "blocked":
+            self.blocked.discard(addr)
+        elif current is not None:
+            level = self.levels[current]
+            del level[addr]
+            if not level:
+                del self.levels[current]
+                self.level_deletions.pop(current, None)
+                return
+
+            # dicts don't shrink when things are deleted from them, and
+            # iterating over one goes over all the deleted entries too. Copy
+            # the level once it's mostly deleted entries
+            deletions = self.level_deletions.get(current, 0) + 1
+            if deletions > 2 * len(level) + 8:
+                self.levels[current] = dict(level)
+                deletions = 0
+            self.level_deletions[current] = deletions
+
+    # Gives up to limit (or all) runnable cores, highest priority first.
+    # Cores that were picked are moved to the back of their level
+    def pick(self, limit=None):
+        picked = []
+        for priority in sorted(self.levels, reverse=True):
+            level = self.levels[priority]
+            if limit is None:
+                picked.extend(level.values())
+                continue
+
+            for addr in list(islice(level, limit - len(picked))):
+                level[addr] = level.pop(addr)
+                picked.append(level[addr])
+            if len(picked) >= limit:
+                break
+
+        for core in picked:
+            stats = self.stats[core.address]
+            wait = self.step - stats.runnable_since
+            stats.scheduled += 1
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+            stats.runnable_since = self.step + 1
+
+        self.step += 1
+        return picked
+
+    def n_runnable(self):
+        return sum(len(level) for level in self.levels.values())
+
+    # Jain's fairness index of how often the cores have been scheduled, 1.0
+    # means everyone got the same amount of turns
+    def fairness_index(self):
+        counts = [stats.scheduled for stats in self.stats.values()]
+        total = sum(counts)
+        if total == 0:
+            return 1.0
+        return total ** 2 / (len(counts) * sum(count ** 2 for count in counts))
+
+    def log_stats(self):
+        VM_LOG.info(f"Scheduler step {self.step}: {self.n_runnable()} runnable, {len(self.idle)} idle, " +
+            f"{len(self.blocked)} blocked, fairness {self.fairness_index():.3f}")
@@ -0,0 +1,535 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+from collections import deque
+
+import websockets
+
+import action
+import vm
+from consensus import Ballot
+from deltas import DeltaBuffer, Subscription
+from journal import Journal, replay
+from snapshot import KEEP_SNAPSHOTS, SnapshotStore, capture
+from log import SERVER_LOG
+from regfile import IP_SLOT
+
+# nginx proxies /ws/ here
+PORT = 8765
+
+# Messages waiting to be sent to one client. A client that lets this many
+# pile up is too slow to keep up and gets disconnected
+OUTBOX_SIZE = 64
+
+# Seconds a human gets to answer before the instruction goes to someone else
+ANSWER_TIMEOUT = 120
+
+# How many cores to ask the scheduler for at once
+REFILL_BATCH = 256
+
+# Seconds of changes that are collected into one delta before sending it
+DELTA_TICK = 0.05
+
+# Most RAM cells a client can watch in one core, or ask for at once
+MAX_WATCHED_CELLS = 4096
+
+# Seconds between two snapshots
+SNAPSHOT_INTERVAL = 60
+
+# Seconds between two fsyncs of the journal
+JOURNAL_SYNC_INTERVAL = 0.2
+
+class Poll:
+    # One instruction being asked to several humans
+    def __init__(self, inst, expected, ballot):
+        self.inst = inst
+        self.expected = expected # the instruction's fake_action
+        self.ballot = ballot
+        self.asked = set() # clients that have been given this instruction
+        self.answered = {} # client: id of the Assignment they answered
+        self.outstanding = set() # Assignments not answered yet
+        self.queued = False # is it in GameServer.pending
+
+    def wants_more(self):
+        return self.ballot.decision is None and not self.queued
+
+class Assignment:
+    __slots__ = ("id", "poll", "client", "deadline")
+
+    def __init__(self, id, poll, client, deadline):
+        self.id = id
+        self.poll = poll
+        self.client = client
+        self.deadline = deadline
+
+class Client:
+    def __init__(self, ws):
+        self.ws = ws
+        self.outbox = asyncio.Queue(OUTBOX_SIZE)
+        self.assignment = None
+        self.closed = False
+        self.weight = 1 # how much this client's answers count in votes
+        self.subscription = Subscription()
+
+    # Never blocks, the message is sent by sender()
+    def send(self, msg):
+        if self.closed:
+            return
+
+        try:
+            self.outbox.put_nowait(json.dumps(msg))
+        except asyncio.QueueFull:
+            SERVER_LOG.warn(f"{self.ws.remote_address} can't keep up, disconnecting")
+            self.closed = True
+            asyncio.get_running_loop().create_task(self.ws.close(1008, "too slow"))
+
+    async def sender(self):
+        while True:
+            msg = await self.outbox.get()
+            try:
+                await self.ws.send(msg)
+            except Exception as error:
+                SERVER_LOG.warn(f"{self.ws.remote_address} send failed, disconnecting: {error!r}")
+                self.closed = True
+                await self.ws.close(1011, "send failed")
+                return
+
+class GameServer:
+    # Hands out the instructions the VM wants to run to connected humans, one
+    # instruction per human at a time, and runs the actions they answer with.
+    #
+    # Every instruction is given to up to n_answers different humans, and
+    # the action that first gets quorum weight of votes behind it is run
+    # (see consensus.py). By default every instruction goes to one human.
+    #
+    # Protocol, all JSON:
+    #   server: {"type": "instruction", "id", "core", "desc", "registers"}
+    #   client: {"type": "answer", "id", "action": Action.to_dict()}
+    #   server: {"type": "accepted"/"rejected"/"timeout"/"error", ...}
+    #   server: {"type": "decided", "id", "agreed"} once the instruction
+    #           has been decided, also sent to whoever hasn't answered yet
+    #
+    # Clients can also watch cores, to see what happens to them:
+    #   client: {"type": "watch", "core", "ram": [[start, end], ...]}
+    #   server: {"type": "state", "core", "regs", "handlers", "idle", "ram"}
+    #   server: {"type": "delta", "cores": {core: changes}} every DELTA_TICK
+    #           if anything they watch changed, see Subscription.filter
+    #   client: {"type": "unwatch", "core"}
+    # Everybody gets {"type": "printed", "msgs"} when something is printed
+    #
+    # And look around in the RAM of a core, for scrolling through it. RAM is
+    # mostly empty, so besides asking for all cells in a window clients can
+    # ask for the next count non-zero cells from an address, going up or
+    # down. Both cost O(log n + k) for n pages in the RAM and k cells given:
+    #   client: {"type": "ram", "core", "start", "length"}
+    #   server: {"type": "ram", "core", "start", "values": [...]}
+    #   client: {"type": "ram-populated", "core", "from", "count", "backwards"}
+    #   server: {"type": "ram-populated", "core", "cells": [[addr, value], ...]}
+    #           starting at from (or just below it when going backwards)
+    # After an accepted answer, a timeout or a decision the client gets its
+    # next instruction as soon as there is one
+    def __init__(self, vm, answer_timeout=ANSWER_TIMEOUT, n_answers=1, quorum=None):
+        self.vm = vm
+        self.answer_timeout = answer_timeout
+        self.n_answers = n_answers
+        self.quorum = n_answers // 2 + 1 if quorum is None else quorum
+
+        self.pending = deque() # Polls that need to be given to more humans
+        self.assigned = {} # id: Assignment
+        self.busy_cores = set() # addrs of cores with an undecided Poll
+        self.waiting = deque() # clients without an instruction
+        self.ids = itertools.count()
+
+        self.clients = set()
+        self.watchers = {} # core addr: set of clients watching it
+        self.vm.deltas = DeltaBuffer()
+
+    # A core whose instruction can't be run (dividing by zero, printing too
+    # much, ...) is faulted so it stops asking, the other cores are still
+    # handed out
+    def refill(self):
+        for inst in self.vm.query_instructions(limit=REFILL_BATCH):
+            if inst.req_addr not in self.busy_cores:
+                core = self.vm.cores.get(inst.req_addr)
+                try:
+                    expected = inst.fake_action(core)
+                except Exception as error:
+                    self.vm.fault(core, error)
+                    continue
+                self.busy_cores.add(inst.req_addr)
+                self.enqueue(Poll(inst, expected, Ballot(expected, self.quorum, self.n_answers)))
+
+    def enqueue(self, poll, front=False):
+        poll.queued = True
+        if front:
+            self.pending.appendleft(poll)
+        else:
+            self.pending.append(poll)
+
+    def still_current(self, inst):
+        core = self.vm.cores.get(inst.req_addr)
+        return core is not None and not core.idle and core.regfile[IP_SLOT] == inst.ip
+
+    # Takes the first Poll the client hasn't been given yet out of pending
+    def next_poll(self, client):
+        for _ in range(2):
+            skipped = []
+            found = None
+            while self.pending:
+                poll = self.pending.popleft()
+                poll.queued = False
+                if not self.still_current(poll.inst):
+                    self.busy_cores.discard(poll.inst.req_addr)
+                elif client in poll.asked:
+                    skipped.append(poll)
+                else:
+                    found = poll
+                    break
+
+            for poll in reversed(skipped):
+                self.enqueue(poll, front=True)
+            if found is not None:
+                return found
+            self.refill()
+        return None
+
+    def dispatch(self):
+        unserved = []
+        while self.waiting:
+            client = self.waiting.popleft()
+            if client.closed:
+                continue
+
+            poll = self.next_poll(client)
+            if poll is None:
+                unserved.append(client)
+                continue
+            self.assign(client, poll)
+
+        self.waiting.extend(unserved)
+
+    def assign(self, client, poll):
+        deadline = asyncio.get_running_loop().time() + self.answer_timeout
+        assignment = Assignment(next(self.ids), poll, client, deadline)
+        self.assigned[assignment.id] = assignment
+        client.assignment = assignment
+
+        poll.asked.add(client)
+        poll.outstanding.add(assignment)
+        if len(poll.outstanding) + len(poll.ballot.voters) < self.n_answers:
+            self.enqueue(poll, front=True)
+
+        inst = poll.inst
+        core = self.vm.cores.get(inst.req_addr)
+        client.send({
+            "type": "instruction",
+            "id": assignment.id,
+            "core": hex(inst.req_addr),
+            "desc": inst.get_desc(),
+            "registers": {reg: hex(val) for reg, val in core.registers.items()},
+        })
+
+    def finish(self, assignment):
+        del self.assigned[assignment.id]
+        assignment.client.assignment = None
+        assignment.poll.outstanding.discard(assignment)
+
+    # Takes the instruction away from whoever had it, and gives it to the next human
+    def unassign(self, assignment):
+        self.finish(assignment)
+        assignment.poll.asked.discard(assignment.client)
+        if assignment.poll.wants_more():
+            self.enqueue(assignment.poll, front=True)
+
+    # Does the answer have any business being the answer to the poll's
+    # instruction. Whether it is the right answer is up to the humans, but
+    # they can only change the core the instruction is from
+    def answer_allowed(self, poll, act):
+        expected = poll.expected
+        if type(act) is not type(expected):
+            return False
+        return isinstance(act, action.SendMessage) or act.affects() == expected.affects()
+
+    def decide(self, poll, decision):
+        if poll.queued:
+            self.pending.remove(poll)
+            poll.queued = False
+        self.busy_cores.discard(poll.inst.req_addr)
+
+        self.vm.complete_instruction(poll.inst, decision.action)
+
+        for assignment in list(poll.outstanding):
+            self.finish(assignment)
+            assignment.client.send({"type": "decided", "id": assignment.id, "agreed": None})
+            self.waiting.append(assignment.client)
+
+        dissenters = set(poll.ballot.dissenters())
+        for voter, id in poll.answered.items():
+            voter.send({"type": "decided", "id": id, "agreed": voter not in dissenters})
+
+    def handle_answer(self, client, msg):
+        assignment = client.assignment
+        if assignment is None or msg.get("id") != assignment.id:
+            client.send({"type": "error", "error": "not your instruction"})
+            return
+
+        try:
+            act = action.from_dict(msg["action"])
+        except (KeyError, ValueError, TypeError, AssertionError):
+            client.send({"type": "error", "error": "malformed action"})
+            return
+
+        poll = assignment.poll
+        if not self.answer_allowed(poll, act):
+            client.send({"type": "rejected", "id": assignment.id})
+            return
+
+        self.finish(assignment)
+        client.send({"type": "accepted", "id": assignment.id})
+
+        poll.answered[client] = assignment.id
+        decision = poll.ballot.add(client, act, client.weight)
+        if decision is not None:
+            self.decide(poll, decision)
+
+        self.waiting.append(client)
+        self.dispatch()
+
+    def on_message(self, client, raw):
+        try:
+            msg = json.loads(raw)
+        except ValueError:
+            client.send({"type": "error", "error": "expected JSON"})
+            return
+
+        handler = self.message_handlers.get(msg.get("type")) if isinstance(msg, dict) else None
+        if handler is None:
+            client.send({"type": "error", "error": "unknown message"})
+            return
+
+        try:
+            handler(self, client, msg)
+        except (KeyError, ValueError, TypeError):
+            client.send({"type": "error", "error": "malformed message"})
+
+    def handle_watch(self, client, msg):
+        addr = action.unhex(msg["core"])
+        ranges = [(action.unhex(start), action.unhex(end)) for start, end in msg["ram"]]
+        if sum(max(end - start, 0) for start, end in ranges) > MAX_WATCHED_CELLS:
+            client.send({"type": "error", "error": f"can't watch more than {MAX_WATCHED_CELLS} cells"})
+            return
+
+        core = self.vm.cores.get(addr)
+        if core is None:
+            client.send({"type": "error", "error": "no such core"})
+            return
+
+        client.subscription.watch(addr, ranges)
+        self.watchers.setdefault(addr, set()).add(client)
+
+        ram = {}
+        for start, end in ranges:
+            for cell, val in core.ram.populated_range(start, end):
+                ram[hex(cell)] = hex(val)
+
+        client.send({
+            "type": "state",
+            "core": hex(addr),
+            "regs": {reg: hex(val) for reg, val in core.registers.items()},
+            "handlers": {hex(atom): [hex(val) for val in handler] for atom, handler in core.handlers.items()},
+            "idle": core.idle,
+            "ram": ram,
+        })
+
+    def handle_unwatch(self, client, msg):
+        addr = action.unhex(msg["core"])
+        client.subscription.unwatch(addr)
+        self.unwatch(client, addr)
+
+    def unwatch(self, client, addr):
+        watchers = self.watchers.get(addr)
+        if watchers is not None:
+            watchers.discard(client)
+            if not watchers:
+                del self.watchers[addr]
+
+    def requested_core(self, client, msg):
+        core = self.vm.cores.get(action.unhex(msg["core"]))
+        if core is None:
+            client.send({"type": "error", "error": "no such core"})
+        return core
+
+    def handle_ram(self, client, msg):
+        start = action.unhex(msg["start"])
+        length = min(action.unhex(msg["length"]), MAX_WATCHED_CELLS)
+        core = self.requested_core(client, msg)
+        if core is None:
+            return
+
+        values = core.ram.read_range(start, length)
+        client.send({"type": "ram", "core": msg["core"], "start": hex(start), "values": [hex(val) for val in values]})
+
+    def handle_ram_populated(self, client, msg):
+        start = action.unhex(msg["from"])
+        count = min(action.unhex(msg["count"]), MAX_WATCHED_CELLS)
+        core = self.requested_core(client, msg)
+        if core is None:
+            return
+
+        if msg.get("backwards", False):
+            cells = core.ram.populated_before(start)
+        else:
+            cells = core.ram.populated_from(start)
+        cells = [[hex(addr), hex(val)] for addr, val in itertools.islice(cells, count)]
+        client.send({"type": "ram-populated", "core": msg["core"], "cells": cells})
+
+    message_handlers = {
+        "answer": handle_answer,
+        "watch": handle_watch,
+        "unwatch": handle_unwatch,
+        "ram": handle_ram,
+        "ram-populated": handle_ram_populated,
+    }
+
+    async def handler(self, ws):
+        client = Client(ws)
+        sender = asyncio.get_running_loop().create_task(client.sender())
+        SERVER_LOG.info(f"{ws.remote_address} connected")
+
+        self.clients.add(client)
+        self.waiting.append(client)
+        self.dispatch()
+        try:
+            async for raw in ws:
+                self.on_message(client, raw)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            client.closed = True
+            sender.cancel()
+            self.clients.discard(client)
+            for addr in client.subscription.ranges:
+                self.unwatch(client, addr)
+            if client.assignment is not None:
+                self.unassign(client.assignment)
+                self.dispatch()
+            SERVER_LOG.info(f"{ws.remote_address} disconnected")
+
+    async def reap_timeouts(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(1)
+            now = loop.time()
+            for assignment in [a for a in self.assigned.values() if a.deadline < now]:
+                self.unassign(assignment)
+                assignment.client.send({"type": "timeout", "id": assignment.id})
+                self.waiting.append(assignment.client)
+            self.dispatch()
+
+    # Sends everything that changed since the last time to whoever watches it
+    def send_deltas(self):
+        cores, printed = self.vm.deltas.take()
+
+        messages = {} # client: {core: changes}
+        for addr, delta in cores.items():
+            for client in self.watchers.get(addr, ()):
+                changes = client.subscription.filter(addr, delta)
+                if changes is not None:
+                    messages.setdefault(client, {})[hex(addr)] = changes
+            if delta.removed:
+                for client in self.watchers.pop(addr, ()):
+                    client.subscription.unwatch(addr)
+
+        for client, changes in messages.items():
+            client.send({"type": "delta", "cores": changes})
+
+        if printed:
+            msgs = [[hex(val) for val in msg] for msg in printed]
+            for client in self.clients:
+                client.send({"type": "printed", "msgs": msgs})
+
+    async def broadcast_deltas(self, tick=DELTA_TICK):
+        while True:
+            await asyncio.sleep(tick)
+            self.send_deltas()
+
+    # Only taking the image stops the game, the writing happens in another
+    # thread. Snapshots know how far into the journal they are
+    async def snapshot_periodically(self, store, interval=SNAPSHOT_INTERVAL):
+        loop = asyncio.get_running_loop()
+        journal = self.vm.journal
+        while True:
+            await asyncio.sleep(interval)
+            image = capture(self.vm, 0 if journal is None else journal.count)
+            if journal is not None:
+                await loop.run_in_executor(None, journal.sync)
+            seq = await loop.run_in_executor(None, store.write, image)
+            SERVER_LOG.info(f"Saved snapshot {seq}")
+
+    async def sync_journal_periodically(self, interval=JOURNAL_SYNC_INTERVAL):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, self.vm.journal.sync)
+
+    async def serve(self, host="localhost", port=PORT, store=None):
+        tasks = [self.reap_timeouts(), self.broadcast_deltas()]
+        if store is not None:
+            tasks.append(self.snapshot_periodically(store))
+        if self.vm.journal is not None:
+            tasks.append(self.sync_journal_periodically())
+
+        async with websockets.serve(self.handler, host, port):
+            SERVER_LOG.info(f"Listening on {host}:{port}")
+            await asyncio.gather(*tasks)
+
+# Gives the VM to serve: rebuilt from the journal if it has anything in it,
+# else restored from the latest snapshot, else the program from the start.
+# A journal has to start where the VM does, as the extra of every snapshot
+# is a position in it, so a new journal next to existing snapshots is a
+# ValueError
+def load_vm(program_path, store=None, journal_path=None):
+    has_journal = journal_path is not None and os.path.exists(journal_path) and os.path.getsize(journal_path) > 0
+    has_snapshot = store is not None and store.seq > 0
+    if journal_path is not None and not has_journal and has_snapshot:
+        raise ValueError(f"{journal_path} is empty but there are snapshots, they can't be replayed from it")
+
+    if has_journal:
+        virt, _ = replay(journal_path, store)
+        virt.decoder.predecode()
+    elif has_snapshot:
+        virt, _ = store.restore()
+        virt.decoder.predecode()
+    else:
+        with open(program_path, "rb") as f:
+            code = f.read()
+        virt = vm.VirtualMachine(code, predecode=True)
+
+    if journal_path is not None:
+        virt.journal = Journal(journal_path, batch=None)
+        if not has_journal:
+            virt.journal.start(virt)
+    return virt
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("program", help="assembled program for the humans to run")
+    argparser.add_argument("--host", default="localhost")
+    argparser.add_argument("--port", type=int, default=PORT)
+    argparser.add_argument("--snapshots", metavar="DIR", help="save snapshots here, and start from the latest one if there is one")
+    argparser.add_argument("--keep-snapshots", type=int, default=KEEP_SNAPSHOTS, metavar="K", help="only keep the newest K snapshots")
+    argparser.add_argument("--journal", metavar="FILE", help="journal every completed instruction here, and start from where it ends if it exists")
+    args = argparser.parse_args()
+
+    logging.getLogger("websockets").setLevel(logging.INFO)
+
+    store = None if args.snapshots is None else SnapshotStore(args.snapshots, args.keep_snapshots)
+    try:
+        virt = load_vm(args.program, store, args.journal)
+    except ValueError as error:
+        argparser.error(str(error))
+
+    asyncio.run(GameServer(virt).serve(args.host, args.port, store))
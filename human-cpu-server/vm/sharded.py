@@ -0,0 +1,149 @@
+import logging
+import multiprocessing
+import random
+
+from autopilot import Autopilot
+from log import VM_LOG
+from vm import VirtualMachine
+
+# How many instructions every shard runs between two exchanges of messages
+STEP_BUDGET = 100000
+
+def shard_of(addr, n_shards):
+    return addr % n_shards
+
+class RemoteCore:
+    # Stands in for a core owned by another shard. Messages sent to it are
+    # queued up to be routed to the right shard
+    def __init__(self, vm, address):
+        self.vm = vm
+        self.address = address
+
+    def receive_message(self, msg_atom, msg_content):
+        self.vm.route(self.address, ("msg", self.address, msg_atom, msg_content))
+
+class ShardVM(VirtualMachine):
+    # The part of a sharded VM living in one worker process. It only has the
+    # cores whose address hashes to this shard, anything involving other
+    # cores ends up in outbound, printing ends up in printed
+    def __init__(self, code, shard_id, n_shards):
+        super().__init__(code, predecode=True, boot=False)
+        self.shard_id = shard_id
+        self.n_shards = n_shards
+
+        self.outbound = [[] for _ in range(n_shards)]
+        self.printed = []
+
+    def owns(self, addr):
+        return shard_of(addr, self.n_shards) == self.shard_id
+
+    def route(self, addr, item):
+        self.outbound[shard_of(addr, self.n_shards)].append(item)
+
+    def get_core_with_addr(self, addr, default_on_not_found=True):
+        if not self.owns(addr):
+            return RemoteCore(self, addr)
+        return super().get_core_with_addr(addr, default_on_not_found)
+
+    def new_actor(self, addr, ip, creator_addr=None):
+        if not self.owns(addr):
+            self.route(addr, ("create", addr, ip, creator_addr))
+            return None
+        return super().new_actor(addr, ip, creator_addr)
+
+    def print_message(self, msg):
+        self.printed.append(msg)
+
+    def deliver(self, item):
+        if item[0] == "msg":
+            _, receiver, atom, content = item
+            core = self.get_core_with_addr(receiver)
+            core.receive_message(atom, content)
+            self.core_changed(core)
+        elif item[0] == "create":
+            _, addr, ip, creator_addr = item
+            self.new_actor(addr, ip, creator_addr)
+
+    def take_outbound(self):
+        outbound, self.outbound = self.outbound, [[] for _ in range(self.n_shards)]
+        printed, self.printed = self.printed, []
+        return outbound, printed
+
+def run_shard(shard_id, n_shards, code, inbox, results, step_budget):
+    logging.disable(logging.INFO)
+
+    vm = ShardVM(code, shard_id, n_shards)
+    autopilot = Autopilot(vm)
+
+    while True:
+        cmd, inbound = inbox.get()
+        if cmd == "stop":
+            results.put((shard_id, len(vm.cores)))
+            return
+
+        for item in inbound:
+            vm.deliver(item)
+
+        executed = autopilot.run(step_budget)
+        outbound, printed = vm.take_outbound()
+        results.put((shard_id, outbound, printed, executed, vm.scheduler.n_runnable()))
+
+class ShardedVM:
+    # Runs the actors spread over n_shards worker processes, by hashing their
+    # address. Every shard runs its own scheduler and autopilot. The shards
+    # run in supersteps: every shard runs up to step_budget instructions, and
+    # then the messages, new actors and prints it made for other shards are
+    # routed there in one batch per shard
+    def __init__(self, code, n_shards, n_actors=1, step_budget=STEP_BUDGET):
+        self.n_shards = n_shards
+        self.output = []
+
+        self.results = multiprocessing.Queue()
+        self.inboxes = [multiprocessing.Queue() for _ in range(n_shards)]
+        self.workers = [
+            multiprocessing.Process(target=run_shard, args=(i, n_shards, code, self.inboxes[i], self.results, step_budget))
+            for i in range(n_shards)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+        self.inbound = [[] for _ in range(n_shards)]
+        for _ in range(n_actors):
+            addr = random.getrandbits(64)
+            self.inbound[shard_of(addr, n_shards)].append(("create", addr, 0, None))
+
+    # Runs until no shard has anything left to run and no messages are on
+    # their way. Gives how many instructions were run
+    def run(self):
+        executed = 0
+        while True:
+            for inbox, inbound in zip(self.inboxes, self.inbound):
+                inbox.put(("step", inbound))
+            self.inbound = [[] for _ in range(self.n_shards)]
+
+            results = sorted(self.results.get() for _ in range(self.n_shards))
+
+            any_runnable = False
+            any_routed = False
+            for shard_id, outbound, printed, shard_executed, n_runnable in results:
+                executed += shard_executed
+                any_runnable = any_runnable or n_runnable > 0
+                self.output.extend(printed)
+                for dest, items in enumerate(outbound):
+                    any_routed = any_routed or bool(items)
+                    self.inbound[dest].extend(items)
+
+            if not any_runnable and not any_routed:
+                return executed
+
+    # Stops the workers, gives how many cores every shard ended up with
+    def close(self):
+        for inbox in self.inboxes:
+            inbox.put(("stop", None))
+
+        n_cores = dict(self.results.get() for _ in range(self.n_shards))
+        for worker in self.workers:
+            worker.join()
+
+        VM_LOG.info(f"Sharded VM stopped, cores per shard: {n_cores}")
+        return [n_cores[i] for i in range(self.n_shards)]
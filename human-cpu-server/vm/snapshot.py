@@ -0,0 +1,427 @@
+import mmap
+import os
+import struct
+import sys
+
+from log import VM_LOG
+from ram import PAGE_SIZE
+from regfile import N_REGISTERS
+from vm import CPU, VirtualMachine
+
+MAGIC = b"HCPUSNAP"
+VERSION = 3
+
+PAGE_BYTES = PAGE_SIZE * 8
+
+# How many of the newest snapshots are kept by default
+KEEP_SNAPSHOTS = 8
+
+U64 = struct.Struct("<Q")
+
+# Where the generation is in a state
+GENERATION_AT = len(MAGIC) + 4 + 1
+
+# A snapshot directory holds
+#   pages-G.bin    - RAM pages, PAGE_BYTES of native endian u64s each, only
+#                    ever appended to. Compacting writes the next generation
+#   state-N.bin    - one per snapshot, everything but the RAM contents:
+#
+#   magic, version u32, byte order of the pages u8, generation of the pages
+#   file u64, extra (for the journal) int
+#   code bytes, policy bytes, inherit_ram u8, number of cores u64
+#   for every core:
+#       address u64, idle u8, priority int, registers int * N_REGISTERS
+#       handlers u64, (atom, expected-content-len, store-content-addr, run-ip) int * 4
+#       mailbox capacity u64, received u64, dropped u64
+#       messages u64, (atom int, content len u64, content int * len)
+#   for every core, in the same order:
+#       pages u64, (page number u64, index of the page in the pages file u64)
+#   where the pages of the first core start u64
+#
+# ints are a length followed by that many bytes of little endian two's
+# complement, as registers aren't limited to u64s. The length is 7 bits per
+# byte, lowest first, with the top bit set on all but the last byte, so it
+# is one byte for anything up to 1016 bits
+
+class Writer:
+    def __init__(self):
+        self.buf = bytearray()
+
+    def u8(self, val):
+        self.buf.append(val)
+
+    def u64(self, val):
+        self.buf += U64.pack(val)
+
+    def varint(self, val):
+        while val >= 0x80:
+            self.buf.append(val & 0x7f | 0x80)
+            val >>= 7
+        self.buf.append(val)
+
+    def int(self, val):
+        n = val.bit_length() // 8 + 1
+        self.varint(n)
+        self.buf += val.to_bytes(n, "little", signed=True)
+
+    def bytes(self, val):
+        self.u64(len(val))
+        self.buf += val
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.at = 0
+
+    def u8(self):
+        self.at += 1
+        return self.data[self.at - 1]
+
+    def u64(self):
+        self.at += 8
+        return U64.unpack_from(self.data, self.at - 8)[0]
+
+    def varint(self):
+        val = 0
+        shift = 0
+        while True:
+            byte = self.u8()
+            val |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return val
+            shift += 7
+
+    def int(self):
+        n = self.data[self.at]
+        if n < 0x80:
+            self.at += 1 + n
+        else:
+            n = self.varint()
+            self.at += n
+        return int.from_bytes(self.data[self.at - n:self.at], "little", signed=True)
+
+    def bytes(self):
+        n = self.u64()
+        self.at += n
+        return bytes(self.data[self.at - n:self.at])
+
+class CoreImage:
+    # A core as it was when the image was taken. ram is a frozen copy, so
+    # the core can keep running while the image is written
+    def __init__(self, core, priority):
+        self.address = core.address
+        self.regfile = list(core.regfile)
+        self.ram = core.ram.snapshot()
+        self.handlers = dict(core.handlers)
+        self.messages = list(core.mailbox.messages)
+        self.capacity = core.mailbox.capacity
+        self.received = core.mailbox.received
+        self.dropped = core.mailbox.dropped
+        self.idle = core.idle
+        self.priority = priority
+
+class Image:
+    def __init__(self, vm, extra=0):
+        self.code = vm.code
+        self.policy = vm.scheduler.policy
+        self.inherit_ram = vm.inherit_ram
+        self.extra = extra
+        self.cores = [CoreImage(core, vm.scheduler.priorities.get(core.address, 0)) for core in vm.cores]
+
+# Takes an image of the whole VM. This is the only part of taking a snapshot
+# that has to happen while nothing runs, it doesn't copy any RAM
+def capture(vm, extra=0):
+    return Image(vm, extra)
+
+# Offsets of the page indices in the state data
+def index_offsets(data):
+    offsets = []
+    r = Reader(data)
+    r.at = U64.unpack_from(data, len(data) - 8)[0]
+    while r.at < len(data) - 8:
+        for _ in range(r.u64()):
+            offsets.append(r.at + 8)
+            r.at += 16
+    return offsets
+
+class SnapshotStore:
+    # Writes snapshots of a VM to a directory, and restores them.
+    #
+    # Taking an image freezes the RAM of every core (see PagedRAM.snapshot),
+    # so a page that is written to after that is a new page object. A page
+    # object that was already written to pages.bin in the last snapshot is
+    # therefore still the same, and only pages that are new or changed
+    # since the last snapshot are written.
+    #
+    # Restoring memory maps pages.bin and uses read-only views into it as
+    # the frozen pages of the restored RAM. Nothing is read until it is
+    # used, and pages are only copied when they are written to.
+    #
+    # Only the newest keep snapshots are kept. Once more than half of the
+    # pages file isn't used by any of them, the used pages are copied to a
+    # new generation of it and the states are changed to point there. Every
+    # file is replaced at once, so after a crash every state still has its
+    # pages, and the pages files no state uses are removed later
+    def __init__(self, directory, keep=KEEP_SNAPSHOTS):
+        assert(keep >= 1)
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+        self.generation = max(self.generations(), default=0)
+        self.pages_path = self.pages_file(self.generation)
+        self.n_pages = os.path.getsize(self.pages_path) // PAGE_BYTES if os.path.exists(self.pages_path) else 0
+        self.stored = {} # id(page): (page, index in the pages file), for the pages in the last snapshot
+        self.used = {} # seq: (generation, indices of the pages it uses)
+
+        self.seq = max(self.snapshots(), default=0)
+
+    def generations(self):
+        gens = []
+        for name in os.listdir(self.directory):
+            if name.startswith("pages-") and name.endswith(".bin"):
+                gens.append(int(name[len("pages-"):-len(".bin")]))
+        return sorted(gens)
+
+    def pages_file(self, generation):
+        return os.path.join(self.directory, f"pages-{generation:08}.bin")
+
+    # Sequence numbers of the snapshots in the directory
+    def snapshots(self):
+        seqs = []
+        for name in os.listdir(self.directory):
+            if name.startswith("state-") and name.endswith(".bin"):
+                seqs.append(int(name[len("state-"):-len(".bin")]))
+        return sorted(seqs)
+
+    def state_path(self, seq):
+        return os.path.join(self.directory, f"state-{seq:08}.bin")
+
+    def save(self, vm, extra=0):
+        return self.write(capture(vm, extra))
+
+    # Writes an image taken by capture(), can be run in another thread.
+    # Gives the sequence number of the snapshot
+    def write(self, image):
+        stored = {}
+        new_pages = []
+
+        w = Writer()
+        w.buf += MAGIC
+        w.buf += struct.pack("<I", VERSION)
+        w.u8(sys.byteorder == "little")
+        w.u64(self.generation)
+        w.int(image.extra)
+        w.bytes(image.code)
+        w.bytes(image.policy.encode())
+        w.u8(image.inherit_ram)
+
+        w.u64(len(image.cores))
+        for core in image.cores:
+            w.u64(core.address)
+            w.u8(core.idle)
+            w.int(core.priority)
+            for val in core.regfile:
+                w.int(val)
+
+            w.u64(len(core.handlers))
+            for atom, handler in core.handlers.items():
+                w.int(atom)
+                for val in handler:
+                    w.int(val)
+
+            w.u64(core.capacity)
+            w.u64(core.received)
+            w.u64(core.dropped)
+            w.u64(len(core.messages))
+            for atom, content in core.messages:
+                w.int(atom)
+                w.u64(len(content))
+                for val in content:
+                    w.int(val)
+
+        pages_at = len(w.buf)
+        for core in image.cores:
+            page_nrs = core.ram.page_index()
+            w.u64(len(page_nrs))
+            for page_nr in page_nrs:
+                page = core.ram.find_page(page_nr)
+                entry = stored.get(id(page)) or self.stored.get(id(page))
+                if entry is None:
+                    entry = (page, self.n_pages + len(new_pages))
+                    new_pages.append(page)
+                stored[id(page)] = entry
+                w.u64(page_nr)
+                w.u64(entry[1])
+        w.u64(pages_at)
+
+        # The pages have to be on disk before a state refers to them
+        with open(self.pages_path, "ab") as f:
+            for page in new_pages:
+                f.write(page)
+            f.flush()
+            os.fsync(f.fileno())
+
+        seq = self.seq + 1
+        self.write_state(seq, w.buf)
+
+        self.seq = seq
+        self.n_pages += len(new_pages)
+        self.stored = stored
+        self.used[seq] = (self.generation, {index for _, index in stored.values()})
+        VM_LOG.info(f"Wrote snapshot {seq}: {len(image.cores)} cores, {len(new_pages)} new of {len(stored)} pages")
+
+        self.prune()
+        return seq
+
+    def write_state(self, seq, data):
+        tmp_path = self.state_path(seq) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path(seq))
+
+    # Gives (generation, indices of the pages) that the snapshot seq uses
+    def pages_used(self, seq):
+        if seq not in self.used:
+            with open(self.state_path(seq), "rb") as f:
+                data = f.read()
+            generation = U64.unpack_from(data, GENERATION_AT)[0]
+            self.used[seq] = (generation, {U64.unpack_from(data, at)[0] for at in index_offsets(data)})
+        return self.used[seq]
+
+    # Removes all but the newest keep snapshots, and the pages only they used
+    def prune(self):
+        seqs = self.snapshots()
+        for seq in seqs[:-self.keep]:
+            os.remove(self.state_path(seq))
+            self.used.pop(seq, None)
+        kept = seqs[-self.keep:]
+
+        used = set()
+        for seq in kept:
+            generation, indices = self.pages_used(seq)
+            if generation == self.generation:
+                used |= indices
+        if 2 * (self.n_pages - len(used)) > self.n_pages:
+            self.compact(kept, sorted(used))
+
+        generations = {self.pages_used(seq)[0] for seq in kept}
+        for generation in self.generations():
+            if generation != self.generation and generation not in generations:
+                os.remove(self.pages_file(generation))
+
+    # Copies the pages in used to the next generation of the pages file, and
+    # points the snapshots in kept that used them there
+    def compact(self, kept, used):
+        generation = self.generation + 1
+        moved = {index: new for new, index in enumerate(used)}
+
+        pages_path = self.pages_file(generation)
+        with open(self.pages_path, "rb") as old, open(pages_path + ".tmp", "wb") as f:
+            for index in used:
+                old.seek(index * PAGE_BYTES)
+                f.write(old.read(PAGE_BYTES))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pages_path + ".tmp", pages_path)
+
+        for seq in kept:
+            if self.pages_used(seq)[0] != self.generation:
+                continue
+            with open(self.state_path(seq), "rb") as f:
+                data = bytearray(f.read())
+            U64.pack_into(data, GENERATION_AT, generation)
+            for at in index_offsets(data):
+                U64.pack_into(data, at, moved[U64.unpack_from(data, at)[0]])
+            self.write_state(seq, data)
+            self.used[seq] = (generation, set(moved[index] for index in self.used[seq][1]))
+
+        VM_LOG.info(f"Compacted snapshot pages from {self.n_pages} to {len(used)}")
+        self.generation = generation
+        self.pages_path = pages_path
+        self.n_pages = len(used)
+        self.stored = {key: (page, moved[index]) for key, (page, index) in self.stored.items()}
+
+    def map_pages(self, generation):
+        path = self.pages_file(generation)
+        n_pages = os.path.getsize(path) // PAGE_BYTES if os.path.exists(path) else 0
+        if n_pages == 0:
+            return None
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), n_pages * PAGE_BYTES, access=mmap.ACCESS_READ)
+        return memoryview(mapped).cast("Q")
+
+    # Reads up to and including extra, gives (generation, extra)
+    def read_header(self, r):
+        assert(r.data[:len(MAGIC)] == MAGIC)
+        r.at = len(MAGIC)
+        assert(struct.unpack_from("<I", r.data, r.at)[0] == VERSION)
+        r.at += 4
+        assert(r.u8() == (sys.byteorder == "little"))
+        generation = r.u64()
+        return generation, r.int()
+
+    # The extra the snapshot seq was saved with, without restoring it
+    def extra(self, seq):
+        with open(self.state_path(seq), "rb") as f:
+            return self.read_header(Reader(f.read(GENERATION_AT + 8 + 256)))[1]
+
+    # Gives (VirtualMachine, extra) from the snapshot seq, by default the latest
+    def restore(self, seq=None):
+        if seq is None:
+            seq = self.seq
+        with open(self.state_path(seq), "rb") as f:
+            r = Reader(f.read())
+
+        generation, extra = self.read_header(r)
+        code = r.bytes()
+        policy = r.bytes().decode()
+        inherit_ram = bool(r.u8())
+        vm = VirtualMachine(code, inherit_ram=inherit_ram, policy=policy, boot=False)
+
+        pages = self.map_pages(generation)
+        views = {} # index: page, so pages shared between cores stay shared
+        stored = {}
+
+        cores = []
+        for _ in range(r.u64()):
+            core = CPU(r.u64(), 0, vm.code, vm.decoder)
+            core.idle = bool(r.u8())
+            cores.append((core, r.int()))
+            core.regfile[:] = [r.int() for _ in range(N_REGISTERS)]
+
+            for _ in range(r.u64()):
+                atom = r.int()
+                core.handlers[atom] = (r.int(), r.int(), r.int())
+
+            core.mailbox.capacity = r.u64()
+            core.mailbox.received = r.u64()
+            core.mailbox.dropped = r.u64()
+            for _ in range(r.u64()):
+                atom = r.int()
+                core.mailbox.messages.append((atom, [r.int() for _ in range(r.u64())]))
+
+        for core, priority in cores:
+            layer = {}
+            for _ in range(r.u64()):
+                page_nr = r.u64()
+                index = r.u64()
+                page = views.get(index)
+                if page is None:
+                    page = views[index] = pages[index * PAGE_SIZE:(index + 1) * PAGE_SIZE]
+                    stored[id(page)] = (page, index)
+                layer[page_nr] = page
+            if layer:
+                core.ram.layers = (layer,)
+                core.ram.index = None
+
+            if priority != 0:
+                vm.scheduler.set_priority(core.address, priority)
+            vm.add_core(core)
+
+        # Pages in an older generation can't be pointed to by new snapshots
+        self.stored = stored if generation == self.generation else {}
+        VM_LOG.info(f"Restored snapshot {seq}: {len(vm.cores)} cores, {len(views)} pages")
+        return vm, extra
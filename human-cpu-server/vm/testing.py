@@ -0,0 +1,757 @@
+import itertools
+import logging
+import random
+import struct
+import unittest
+
+logging.disable(logging.INFO)
+
+import action
+import vm
+from autopilot import Autopilot
+from batch import BatchExecutor, partition
+from consensus import Ballot
+from deltas import DeltaBuffer, Subscription
+from ram import PagedRAM
+from regfile import IP_SLOT
+from scheduler import Scheduler
+
+def core_state(core):
+    return (
+        core.address,
+        list(core.regfile),
+        dict(core.ram.populated()),
+        dict(core.handlers),
+        list(core.mailbox.messages),
+        core.idle,
+    )
+
+def vm_state(virt):
+    return [core_state(core) for core in virt.cores]
+
+def make_vm(seed):
+    random.seed(seed)
+    virt = vm.VirtualMachine(b"SAxI")
+    for i in range(7):
+        virt.new_actor(i + 1, 0)
+
+    virt.printed = []
+    virt.print_message = virt.printed.append
+    return virt
+
+def random_actions(rng, addrs, n):
+    actions = []
+    for i in range(n):
+        kind = rng.randrange(6)
+        addr = rng.choice(addrs)
+        if kind == 0:
+            actions.append(action.WriteToCPU(addr, {rng.randrange(4): rng.randrange(100)}, {"rx": rng.randrange(100)}))
+        elif kind == 1:
+            actions.append(action.MakeNewHandler(addr, rng.randrange(3), 1, 0x10, 3))
+        elif kind == 2:
+            actions.append(action.SendMessage(addr, rng.randrange(3), [rng.randrange(100)]))
+        elif kind == 3:
+            actions.append(action.GoIdle(addr))
+        elif kind == 4:
+            actions.append(action.Print(f"message {i}"))
+        else:
+            actions.append(action.CreateActor(0x1000 + i, 0, addr))
+    return actions
+
+class TestActors(unittest.TestCase):
+    def test_finished_actors_are_removed(self):
+        virt = vm.VirtualMachine(b"I") # Idle
+        virt.deltas = DeltaBuffer()
+        finished = virt.cores.first().address
+        virt.new_actor(1, 0)
+        virt.cores.get(1).handlers[5] = (0, 0, 0)
+
+        Autopilot(virt).run()
+
+        # Only the core that can still get a message is left
+        self.assertEqual([core.address for core in virt.cores], [1])
+        self.assertEqual(virt.scheduler.idle, {1})
+        self.assertNotIn(finished, virt.scheduler.stats)
+        self.assertTrue(virt.deltas.cores[finished].removed)
+
+class TestScheduler(unittest.TestCase):
+    def make_cores(self, scheduler, n):
+        cores = [vm.CPU(addr, 0, b"SAxI") for addr in range(1, n + 1)]
+        for core in cores:
+            scheduler.add(core)
+        return cores
+
+    def addrs(self, cores):
+        return [core.address for core in cores]
+
+    def test_priority_first(self):
+        scheduler = Scheduler("priority")
+        self.make_cores(scheduler, 3)
+        scheduler.set_priority(2, 5)
+        scheduler.set_priority(3, -1)
+
+        self.assertEqual(self.addrs(scheduler.pick()), [2, 1, 3])
+        self.assertEqual(self.addrs(scheduler.pick(1)), [2])
+        self.assertEqual(self.addrs(scheduler.pick(2)), [2, 1])
+
+    def test_same_priority_rotates(self):
+        scheduler = Scheduler("round-robin")
+        self.make_cores(scheduler, 3)
+
+        self.assertEqual(self.addrs(scheduler.pick(2)), [1, 2])
+        self.assertEqual(self.addrs(scheduler.pick(2)), [3, 1])
+        self.assertEqual(self.addrs(scheduler.pick(2)), [2, 3])
+
+    def test_idle_and_blocked_not_picked(self):
+        scheduler = Scheduler()
+        runnable, idle, blocked = self.make_cores(scheduler, 3)
+        idle.idle = True
+        blocked.regfile[IP_SLOT] = 100
+        scheduler.update(idle)
+        scheduler.update(blocked)
+
+        self.assertEqual(scheduler.pick(), [runnable])
+        self.assertEqual(scheduler.idle, {idle.address})
+        self.assertEqual(scheduler.blocked, {blocked.address})
+
+        idle.idle = False
+        scheduler.update(idle)
+        self.assertEqual(scheduler.pick(), [runnable, idle])
+
+    def test_fairness_index(self):
+        scheduler = Scheduler("priority")
+        self.make_cores(scheduler, 2)
+        self.assertEqual(scheduler.fairness_index(), 1.0)
+
+        # One core gets every turn: 3^2 / (2 * (3^2 + 0^2))
+        scheduler.set_priority(1, 1)
+        for _ in range(3):
+            scheduler.pick(1)
+        self.assertEqual(scheduler.fairness_index(), 0.5)
+
+        # Then the other catches up: 6^2 / (2 * (3^2 + 3^2))
+        scheduler.set_priority(2, 2)
+        for _ in range(3):
+            scheduler.pick(1)
+        self.assertEqual(scheduler.fairness_index(), 1.0)
+        self.assertEqual(scheduler.stats[2].max_wait, 3)
+
+class TestRAM(unittest.TestCase):
+    def test_populated_queries(self):
+        rng = random.Random(6)
+        ram = PagedRAM()
+        cells = {}
+        for i in range(2000):
+            addr = rng.choice([rng.randrange(1 << 12), rng.randrange(1 << 64)])
+            val = rng.choice([0, rng.randrange(1, 100)])
+            ram[addr] = val
+            cells[addr] = val
+            if i % 500 == 0:
+                ram = ram.snapshot()
+        populated = sorted((addr, val) for addr, val in cells.items() if val != 0)
+
+        self.assertEqual(list(ram.populated()), populated)
+        for _ in range(100):
+            start = rng.choice([rng.randrange(1 << 12), rng.randrange(1 << 64)])
+            end = start + rng.randrange(1 << 10)
+            self.assertEqual(list(ram.populated_range(start, end)), [c for c in populated if start <= c[0] < end])
+            self.assertEqual(list(itertools.islice(ram.populated_from(start), 5)), [c for c in populated if c[0] >= start][:5])
+            self.assertEqual(list(itertools.islice(ram.populated_before(start), 5)), [c for c in populated if c[0] < start][::-1][:5])
+
+    def test_zero_pages(self):
+        ram = PagedRAM()
+        for page_nr in range(100):
+            ram[page_nr << 8] = 0
+        self.assertEqual(ram.page_index(), [])
+
+        ram[0x305] = 7
+        ram[0x305] = 0
+        self.assertEqual(ram.page_index(), [])
+
+        # The zeroed copy has to stay to hide the frozen 7
+        ram[0x305] = 7
+        copy = ram.snapshot()
+        self.assertIsNone(copy.index)
+        ram[0x305] = 0
+        self.assertEqual(ram.page_index(), [3])
+        self.assertEqual(list(ram.populated()), [])
+        self.assertEqual(list(copy.populated_range(0x300, 0x306)), [(0x305, 7)])
+        self.assertEqual(list(copy.populated_range(0x306, 0x400)), [])
+
+    def test_spawn_loop(self):
+        # A creator that writes a counter between spawns
+        ram = PagedRAM()
+        for page_nr in range(4096):
+            ram[page_nr << 8] = page_nr + 1
+        base = ram.snapshot().layers[0]
+
+        children = []
+        for i in range(1000):
+            ram[0x42] = i
+            children.append(ram.snapshot())
+
+        # The big layer is never copied again, and the small ones don't pile up
+        self.assertIs(ram.layers[-1], base)
+        self.assertLessEqual(len(ram.layers), 3)
+        for i, child in enumerate(children):
+            self.assertEqual(child[0x42], i)
+            self.assertEqual(child[4095 << 8], 4096)
+
+class TestBatch(unittest.TestCase):
+    def test_partition(self):
+        w1 = action.WriteToCPU(1, {}, {"rx": 1})
+        w2 = action.WriteToCPU(2, {}, {"rx": 2})
+        w3 = action.WriteToCPU(1, {}, {"rx": 3})
+        p = action.Print("hi")
+        w4 = action.WriteToCPU(2, {}, {"rx": 4})
+
+        self.assertEqual(
+            partition([w1, w2, w3, p, w4]),
+            [ ("groups", [[w1, w3], [w2]])
+            , ("barrier", p)
+            , ("groups", [[w4]])
+            ]
+        )
+
+    def test_same_result_as_sequential(self):
+        rng = random.Random(1234)
+        for seed in range(20):
+            sequential = make_vm(seed)
+            batched = make_vm(seed)
+            addrs = [core.address for core in sequential.cores]
+            actions = random_actions(rng, addrs, 300)
+
+            for act in actions:
+                act.run(sequential)
+
+            executor = BatchExecutor(batched, max_workers=4)
+            executor.run(actions)
+            executor.shutdown()
+
+            self.assertEqual(vm_state(batched), vm_state(sequential))
+            self.assertEqual(batched.printed, sequential.printed)
+            self.assertEqual(batched.scheduler.idle, sequential.scheduler.idle)
+            self.assertEqual(batched.scheduler.blocked, sequential.scheduler.blocked)
+
+def N(val):
+    return b"N" + struct.pack("Q", val)
+
+STRAIGHT_LINE = (
+    b"Sx" + N(7) +          # Set $rx #7
+    b"*yx" + N(6) +         # Mul $ry $rx #6
+    b"s" + N(0x10) + b"y" + # SetMem #0x10 $ry
+    b"Rz" + N(0x10) +       # ReadMem $rz #0x10
+    b"-Azx" +               # Sub $ra $rz $rx
+    b"<H" + N(1) + b"A" +   # LT $rhen #1 $ra
+    b"?X"                   # Self-addr $brian
+)
+
+class TestAutopilot(unittest.TestCase):
+    def test_same_result_as_fake_action(self):
+        random.seed(1)
+        reference = vm.VirtualMachine(STRAIGHT_LINE)
+        core = reference.cores.first()
+        while True:
+            instructions = core.query_instructions()
+            if not instructions:
+                break
+            ip = core.regfile[IP_SLOT]
+            instructions[0].fake_action(core).run(reference)
+            core.regfile[IP_SLOT] = ip + reference.decoder.decode(ip)[1]
+
+        random.seed(1)
+        autopiloted = vm.VirtualMachine(STRAIGHT_LINE)
+        self.assertEqual(Autopilot(autopiloted).run(), 7)
+
+        self.assertEqual(vm_state(autopiloted), vm_state(reference))
+        self.assertEqual(core.registers["ra"], 35)
+        self.assertEqual(core.registers["rhen"], 1)
+
+    def test_blocks_same_as_single_steps(self):
+        # STRAIGHT_LINE, then Add $rz $rz $ip and back to the start
+        code = STRAIGHT_LINE + b"+zz@" + b"S@" + N(0)
+
+        states = []
+        for use_blocks in [False, True]:
+            random.seed(2)
+            virt = vm.VirtualMachine(code)
+            self.assertEqual(Autopilot(virt, use_blocks=use_blocks).run(1234), 1234)
+            states.append(vm_state(virt))
+
+        self.assertEqual(states[0], states[1])
+
+    def test_registers_wrap_like_ram(self):
+        code = (
+            b"-x" + N(0) + N(1) +   # Sub $rx #0 #1
+            b"s" + N(0x10) + b"x" + # SetMem #0x10 $rx
+            b"Ry" + N(0x10) +       # ReadMem $ry #0x10
+            b"=zxy" +               # EQ $rz $rx $ry
+            b"*Ax" + N(3)           # Mul $ra $rx #3
+        )
+
+        states = []
+        for use_blocks in [False, True, None]:
+            random.seed(3)
+            virt = vm.VirtualMachine(code)
+            core = virt.cores.first()
+            if use_blocks is None:
+                # Through the actions, like the humans would
+                while core.query_instructions():
+                    inst = core.query_instructions()[0]
+                    virt.complete_instruction(inst, inst.fake_action(core))
+            else:
+                Autopilot(virt, use_blocks=use_blocks).run()
+            states.append(vm_state(virt))
+
+            self.assertEqual(core.registers["rx"], (1 << 64) - 1)
+            self.assertEqual(core.registers["rz"], 1)
+            self.assertEqual(core.registers["ra"], (1 << 64) - 3)
+        self.assertEqual(states[0], states[1])
+        self.assertEqual(states[0], states[2])
+
+        # Answers are the same whichever way they wrap
+        self.assertEqual(action.WriteToCPU(1, {}, {"rx": -1}), action.WriteToCPU(1, {}, {"rx": (1 << 64) - 1}))
+
+    def test_fault_stops_only_that_core(self):
+        from lockstep import LockstepEngine
+
+        faulting = b"Sx" + N(5) + b"/yx" + N(0) # Set $rx #5, Div $ry $rx #0
+        code = faulting + STRAIGHT_LINE
+        for run in [lambda virt: Autopilot(virt, use_blocks=False).run(),
+                    lambda virt: Autopilot(virt).run(),
+                    lambda virt: LockstepEngine(virt).run()]:
+            virt = vm.VirtualMachine(code)
+            first = virt.cores.first()
+            other = virt.new_actor(1, len(faulting))
+            run(virt)
+
+            self.assertIsInstance(first.fault, ZeroDivisionError)
+            self.assertEqual(first.regfile[IP_SLOT], len(b"Sx" + N(5)))
+            self.assertEqual(first.registers["rx"], 5)
+            self.assertEqual(virt.scheduler.blocked, {first.address, other.address})
+            self.assertEqual(other.registers["ra"], 35)
+
+    def test_print_too_long(self):
+        virt = vm.VirtualMachine(b"#" + N(1 << 40) + N(0)) # Print #0x10000000000 #0
+        virt.printed = []
+        virt.print_message = virt.printed.append
+        Autopilot(virt).run()
+
+        self.assertIsInstance(virt.cores.first().fault, ValueError)
+        self.assertEqual(virt.printed, [])
+
+    def test_messages(self):
+        def program(handler_ip):
+            return (
+                b"!" + N(1) + N(1) + N(0x10) + N(handler_ip) + # Make-handler #1 #1 #0x10 'handler
+                b"?A" +                                          # Self-addr $ra
+                b"s" + N(0x20) + N(42) +                         # SetMem #0x20 #42
+                b"^A" + N(1) + N(1) + N(0x20) +                  # Send-msg $ra #1 #1 #0x20
+                b"I"                                             # Idle
+            )
+        code = program(len(program(0))) + b"Rx" + N(0x10) # 'handler ReadMem $rx #0x10
+
+        virt = vm.VirtualMachine(code)
+        Autopilot(virt).run()
+
+        core = virt.cores.first()
+        self.assertEqual(core.registers["rx"], 42)
+        self.assertEqual(virt.scheduler.blocked, {core.address})
+
+class TestLockstep(unittest.TestCase):
+    def test_same_result_as_autopilot(self):
+        from lockstep import LockstepEngine
+
+        code = (
+            b"-yx" + N(5) +        # Sub $ry $rx #5, doesn't fit in a u64 for $rx < 5
+            b"<zx" + N(10) +       # LT $rz $rx #10
+            b"*zz" + N(16) +       # Mul $rz $rz #16
+            b"+@@z" +              # Add $ip $ip $rz, skips the next instruction if $rx < 10
+            b"+HH" + N(1) +        # Add $rhen $rhen #1
+            b"/Ay" + N(2) +        # Div $ra $ry #2
+            b"]Xx" + N(15)         # GE $brian $rx #15
+        )
+
+        states = []
+        for make_engine in [Autopilot, LockstepEngine]:
+            random.seed(3)
+            virt = vm.VirtualMachine(code)
+            for i in range(40):
+                virt.new_actor(i + 1, 0)
+            for i, core in enumerate(virt.cores):
+                core.registers["rx"] = i
+
+            self.assertEqual(make_engine(virt).run(), 41 * 6 + 31)
+            states.append(vm_state(virt))
+
+        self.assertEqual(states[0], states[1])
+
+class TestSharded(unittest.TestCase):
+    def test_spawn_and_message(self):
+        from sharded import ShardedVM
+
+        def program(got_ip, child_ip):
+            return (
+                b"!" + N(1) + N(1) + N(0x10) + N(got_ip) + # Make-handler #1 #1 #0x10 'got
+                b"}" + N(child_ip) +                         # Create-actor 'child
+                b"I"                                         # Idle
+            )
+        got = b"#" + N(1) + N(0x10) + b"I"                   # 'got Print #1 #0x10, Idle
+        child = (
+            b"?x" +                                          # 'child Self-addr $rx
+            b"s" + N(0x20) + b"x" +                          # SetMem #0x20 $rx
+            b"^A" + N(1) + N(1) + N(0x20)                    # Send-msg $ra #1 #1 #0x20
+        )
+        start_len = len(program(0, 0))
+        code = program(start_len, start_len + len(got)) + got + child
+
+        for n_shards in [1, 3]:
+            sharded = ShardedVM(code, n_shards, n_actors=50, step_budget=20)
+            sharded.run()
+            n_cores = sharded.close()
+
+            self.assertEqual(sum(n_cores), 100)
+            self.assertEqual(len(sharded.output), 50)
+            self.assertEqual(len(set(msg[0] for msg in sharded.output)), 50)
+
+class TestConsensus(unittest.TestCase):
+    def test_keys_follow_eq(self):
+        rng = random.Random(5)
+        actions = random_actions(rng, [1, 2], 200) + random_actions(rng, [1, 2], 200)
+        for a in actions[:100]:
+            for b in actions:
+                self.assertEqual(a == b, a.key() == b.key())
+
+        self.assertEqual(action.CreateActor(1, 5, 2).key(), action.CreateActor(3, 5, 2).key())
+
+    def test_voting(self):
+        right = action.WriteToCPU(1, {}, {"rx": 5, "ry": 6})
+        wrong = action.WriteToCPU(1, {}, {"rx": 5})
+
+        # Decided as soon as two agree, whatever comes later doesn't matter
+        ballot = Ballot(right, quorum=2, max_answers=5)
+        self.assertIsNone(ballot.add("a", wrong))
+        self.assertIsNone(ballot.add("b", action.WriteToCPU(1, {}, {"ry": 6, "rx": 5})))
+        decision = ballot.add("c", right)
+        self.assertEqual(decision.action, right)
+        self.assertTrue(decision.agrees)
+        self.assertIsNone(ballot.add("d", wrong))
+        self.assertEqual(ballot.dissenters(), ["a"])
+
+        # Weighted, and a tie once everyone has answered goes to fake_action
+        ballot = Ballot(right, quorum=10, max_answers=3)
+        self.assertIsNone(ballot.add("a", wrong, weight=3))
+        self.assertIsNone(ballot.add("b", right, weight=2))
+        self.assertEqual(ballot.add("c", right, weight=1).action, right)
+
+        ballot = Ballot(right, quorum=10, max_answers=2)
+        ballot.add("a", wrong, weight=3)
+        decision = ballot.add("b", right, weight=2)
+        self.assertEqual(decision.action, wrong)
+        self.assertFalse(decision.agrees)
+
+class TestDeltas(unittest.TestCase):
+    def test_deltas(self):
+        virt = make_vm(1)
+        virt.deltas = DeltaBuffer()
+        core = virt.cores.first()
+        sub = Subscription()
+        sub.watch(core.address, [(0x10, 0x20), (0x100, 0x101), (0x18, 0x30)])
+
+        action.WriteToCPU(core.address, {0x10: 1, 0x30: 2, 0x100: 3}, {"rx": 4}).run(virt)
+        action.WriteToCPU(core.address, {0x10: 5}, {}).run(virt)
+        action.MakeNewHandler(core.address, 7, 2, 0x2f, 0x40).run(virt)
+        action.GoIdle(core.address).run(virt)
+        action.SendMessage(core.address, 7, [8, 9]).run(virt)
+
+        cores, printed = virt.deltas.take()
+        self.assertEqual(
+            sub.filter(core.address, cores[core.address]),
+            { "idle": False
+            , "regs": {"rx": "0x4", "ip": "0x40"}
+            , "handlers": {"0x7": ["0x2", "0x2f", "0x40"]}
+            , "ram": {"0x10": "0x5", "0x100": "0x3", "0x2f": "0x8"}
+            }
+        )
+        self.assertEqual(virt.deltas.take(), ({}, []))
+
+    def test_create_at_taken_address(self):
+        virt = make_vm(1)
+        virt.deltas = DeltaBuffer()
+
+        action.CreateActor(1, 0, 2).run(virt)
+        self.assertEqual(virt.deltas.take(), ({}, []))
+
+        action.CreateActor(0x100, 0, 2).run(virt)
+        cores, _ = virt.deltas.take()
+        self.assertTrue(cores[0x100].created)
+
+class TestSnapshot(unittest.TestCase):
+    def test_restore(self):
+        import tempfile
+        from snapshot import SnapshotStore
+
+        virt = make_vm(7)
+        virt.inherit_ram = True
+        rng = random.Random(7)
+        addrs = [core.address for core in virt.cores]
+        for act in random_actions(rng, addrs, 300):
+            act.run(virt)
+        first = virt.cores.first()
+        first.registers["rz"] = -5
+        first.registers["ry"] = 1 << 100
+        first.registers["rx"] = -(7 ** 5000) # too long for a one byte length
+        for i in range(0, 1 << 16, 7):
+            first.ram[i * 1000] = i
+        virt.new_actor(0x1234, 0, first.address)
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = SnapshotStore(directory)
+            self.assertEqual(store.save(virt), 1)
+            n_pages = store.n_pages
+            expected = vm_state(virt)
+
+            # Only the changed page is written again
+            first.ram[0] = 0xabc
+            store.save(virt)
+            self.assertEqual(store.n_pages, n_pages + 1)
+
+            restored, _ = SnapshotStore(directory).restore(1)
+            self.assertEqual(vm_state(restored), expected)
+            self.assertEqual(restored.scheduler.where, virt.scheduler.where)
+
+            restored, _ = SnapshotStore(directory).restore()
+            self.assertEqual(vm_state(restored), vm_state(virt))
+
+            # Restored RAM can be written to, without changing the snapshot
+            restored.cores.first().ram[1] = 5
+            self.assertEqual(restored.cores.first().ram[1], 5)
+            again, _ = SnapshotStore(directory).restore()
+            self.assertEqual(vm_state(again), vm_state(virt))
+
+    def test_prune(self):
+        import os
+        import tempfile
+        from snapshot import PAGE_BYTES, SnapshotStore
+
+        virt = make_vm(3)
+        first = virt.cores.first()
+        with tempfile.TemporaryDirectory() as directory:
+            store = SnapshotStore(directory, keep=2)
+            states = {}
+            for i in range(20):
+                # Every page is changed, so the old ones aren't used anymore
+                for page_nr in range(8):
+                    first.ram[page_nr * 0x1000] = i + 1
+                states[store.save(virt)] = vm_state(virt)
+
+            self.assertEqual(store.snapshots(), [19, 20])
+            self.assertGreater(store.generation, 0)
+            self.assertEqual(len([name for name in os.listdir(directory) if name.startswith("pages-")]), 1)
+            self.assertLessEqual(os.path.getsize(store.pages_path), 4 * 8 * PAGE_BYTES)
+
+            for seq in [19, 20]:
+                restored, _ = SnapshotStore(directory).restore(seq)
+                self.assertEqual(vm_state(restored), states[seq])
+
+            # Going on from a restored snapshot only writes what changed
+            reopened = SnapshotStore(directory, keep=2)
+            restored, _ = reopened.restore()
+            n_pages = reopened.n_pages
+            restored.cores.first().ram[0] = 0xabc
+            reopened.save(restored)
+            self.assertEqual(reopened.n_pages, n_pages + 1)
+            again, _ = SnapshotStore(directory).restore()
+            self.assertEqual(vm_state(again), vm_state(restored))
+
+class TestJournal(unittest.TestCase):
+    def test_replay(self):
+        import os
+        import tempfile
+        from journal import Journal, replay
+        from snapshot import SnapshotStore
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "journal")
+            store = SnapshotStore(os.path.join(directory, "snapshots"))
+
+            random.seed(8)
+            virt = vm.VirtualMachine(STRAIGHT_LINE + b"I")
+            virt.journal = Journal(path, batch=3)
+            virt.journal.start(virt)
+
+            # Answer like the humans would, with a snapshot half way
+            states = [vm_state(virt)]
+            while True:
+                instructions = virt.query_instructions()
+                if not instructions:
+                    break
+                inst = instructions[0]
+                virt.complete_instruction(inst, inst.fake_action(virt.cores.get(inst.req_addr)))
+                states.append(vm_state(virt))
+                if virt.journal.count == 4:
+                    store.save(virt, virt.journal.count)
+            virt.journal.close()
+
+            reopened = Journal(path)
+            self.assertEqual(reopened.count, len(states) - 1)
+            reopened.close()
+            for until in range(len(states)):
+                for with_store in [None, store]:
+                    replayed, position = replay(path, with_store, until)
+                    self.assertEqual(position, until)
+                    self.assertEqual(vm_state(replayed), states[until])
+
+            # A record cut short at the end is left out
+            with open(path, "ab") as f:
+                f.write(b"\x10\x00\x00\x00\x01")
+            replayed, position = replay(path)
+            self.assertEqual(position, len(states) - 1)
+            self.assertEqual(vm_state(replayed), states[-1])
+
+    def test_restart_after_torn_record(self):
+        import os
+        import tempfile
+        from journal import Journal, replay
+
+        def run(virt, n):
+            for _ in range(n):
+                inst = virt.query_instructions()[0]
+                virt.complete_instruction(inst, inst.fake_action(virt.cores.get(inst.req_addr)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "journal")
+
+            # STRAIGHT_LINE over and over
+            virt = vm.VirtualMachine(STRAIGHT_LINE + b"S@" + N(0))
+            virt.journal = Journal(path)
+            virt.journal.start(virt)
+            run(virt, 5)
+            virt.journal.close()
+
+            # Crashed in the middle of writing a record, then restarted
+            with open(path, "ab") as f:
+                f.write(b"\x10\x00\x00\x00\x01")
+            virt.journal = Journal(path)
+            self.assertEqual(virt.journal.count, 5)
+            run(virt, 3)
+            virt.journal.close()
+
+            replayed, position = replay(path)
+            self.assertEqual(position, 8)
+            self.assertEqual(vm_state(replayed), vm_state(virt))
+
+    def test_server_resume(self):
+        import os
+        import tempfile
+        from server import load_vm
+        from snapshot import SnapshotStore
+
+        def run(virt, n):
+            for _ in range(n):
+                inst = virt.query_instructions()[0]
+                virt.complete_instruction(inst, inst.fake_action(virt.cores.get(inst.req_addr)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            program = os.path.join(directory, "program")
+            with open(program, "wb") as f:
+                f.write(STRAIGHT_LINE + b"S@" + N(0))
+            path = os.path.join(directory, "journal")
+            store = SnapshotStore(os.path.join(directory, "snapshots"))
+
+            virt = load_vm(program, store, path)
+            run(virt, 5)
+            store.save(virt, virt.journal.count)
+            run(virt, 3)
+            virt.journal.close()
+
+            resumed = load_vm(program, SnapshotStore(store.directory), path)
+            self.assertEqual(vm_state(resumed), vm_state(virt))
+            resumed.journal.close()
+
+            # The snapshots are at positions in the old journal
+            with self.assertRaises(ValueError):
+                load_vm(program, SnapshotStore(store.directory), os.path.join(directory, "new-journal"))
+
+class TestServer(unittest.TestCase):
+    def test_answering(self):
+        import asyncio
+        import json
+        import websockets
+        from server import GameServer
+
+        # Set $rx #5, Set $ry $rx
+        virt = vm.VirtualMachine(b"Sx" + N(5) + b"Syx")
+        game = GameServer(virt)
+        core = virt.cores.first()
+
+        async def play():
+            async with websockets.serve(game.handler, "localhost", 0) as ws_server:
+                port = ws_server.sockets[0].getsockname()[1]
+                async with websockets.connect(f"ws://localhost:{port}") as ws:
+                    for expected_rx in [5, 5]:
+                        msg = json.loads(await ws.recv())
+                        self.assertEqual(msg["type"], "instruction")
+                        self.assertEqual(msg["core"], hex(core.address))
+
+                        [inst] = core.query_instructions()
+                        self.assertEqual(msg["desc"], inst.get_desc())
+
+                        # Somebody else's core is off limits
+                        wrong = action.WriteToCPU(core.address + 1, {}, {"rx": 1})
+                        await ws.send(json.dumps({"type": "answer", "id": msg["id"], "action": wrong.to_dict()}))
+                        self.assertEqual(json.loads(await ws.recv())["type"], "rejected")
+
+                        answer = inst.fake_action(core).to_dict()
+                        await ws.send(json.dumps({"type": "answer", "id": msg["id"], "action": answer}))
+                        self.assertEqual(json.loads(await ws.recv())["type"], "accepted")
+                        self.assertEqual(json.loads(await ws.recv()), {"type": "decided", "id": msg["id"], "agreed": True})
+                        self.assertEqual(core.registers["rx"], expected_rx)
+
+        asyncio.run(play())
+        self.assertEqual(core.registers["ry"], 5)
+        self.assertEqual(core.state(), "blocked")
+
+    def test_unrunnable_instruction(self):
+        from server import GameServer
+
+        faulting = b"Sx" + N(0) + b"/yx" + N(0) # Set $rx #0, Div $ry $rx #0
+        virt = vm.VirtualMachine(faulting + b"Sx" + N(5))
+        first = virt.cores.first()
+        other = virt.new_actor(1, len(faulting))
+        first.regfile[IP_SLOT] = len(b"Sx" + N(0))
+        game = GameServer(virt)
+        game.refill()
+
+        self.assertIsInstance(first.fault, ZeroDivisionError)
+        self.assertEqual(first.state(), "blocked")
+        self.assertEqual([poll.inst.req_addr for poll in game.pending], [other.address])
+
+    def test_send_failure_closes_client(self):
+        import asyncio
+        from server import Client
+
+        class BrokenSocket:
+            remote_address = "broken"
+            close_code = None
+
+            async def send(self, msg):
+                raise OSError("connection reset")
+
+            async def close(self, code, reason):
+                self.close_code = code
+
+        async def run():
+            ws = BrokenSocket()
+            client = Client(ws)
+            client.send({"type": "decided"})
+            await asyncio.wait_for(client.sender(), 1)
+            return client, ws
+
+        client, ws = asyncio.run(run())
+        self.assertTrue(client.closed)
+        self.assertEqual(ws.close_code, 1011)
+
+
+if __name__ == '__main__':
+    unittest.main()
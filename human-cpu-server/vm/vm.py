@@ -1,74 +1,210 @@
 import random
-from collections import defaultdict
 
 from log import VM_LOG, CPU_LOG
-from instruction import parse_instruction
+from decoder import DecodeCache
+from registry import CoreRegistry
+from regfile import IP_SLOT, NamedRegisters, new_regfile
+from ram import PagedRAM
+from mailboxes import Mailbox
+from scheduler import Scheduler
 
 class CPU:
-    def __init__(self, address, ip, code_ref):
+    __slots__ = ("address", "code_ref", "decoder", "regfile", "ram", "handlers", "mailbox", "idle", "fault")
+
+    def __init__(self, address, ip, code_ref, decoder=None):
         self.address = address
 
         self.code_ref = code_ref
+        self.decoder = decoder if decoder is not None else DecodeCache(code_ref)
 
-        self.registers = {
-            "ip": ip,
-            "ra": 0,
-            "rx": 0,
-            "ry": 0,
-            "rz": 0,
-            "brian": 0,
-        }
+        self.regfile = new_regfile(ip) # indexed by REGISTER_SLOTS
 
-        self.ram = defaultdict(int) # addr: value
+        self.ram = PagedRAM()
 
         self.handlers = {} # atom: (expected-content-len, store-content-addr, run-ip)
 
+        self.mailbox = Mailbox()
+        self.idle = False # Waiting for a message, no instructions to run
+        self.fault = None # The exception its instruction at $ip raised, it doesn't run after that
+
         CPU_LOG.info(f"Made a CPU with address {hex(self.address)}")
 
+    @property
+    def registers(self):
+        return NamedRegisters(self.regfile)
+
+    # Gives whether the message was handled right away
     def receive_message(self, msg_atom, msg_content):
         CPU_LOG.info(f"{hex(self.address)} got a message: {msg_atom}/{msg_content}")
 
+        if self.idle and msg_atom in self.handlers:
+            self.handle_message(msg_atom, msg_content)
+            return True
+
+        if not self.mailbox.push(msg_atom, msg_content):
+            CPU_LOG.warn(f"{hex(self.address)} has a full mailbox, dropped {msg_atom}/{msg_content}")
+        return False
+
+    def handle_message(self, msg_atom, msg_content):
+        expected_content_len, content_addr, run_ip = self.handlers[msg_atom]
+
+        for i, val in enumerate(msg_content[:expected_content_len]):
+            self.ram[content_addr + i] = val
+
+        self.regfile[IP_SLOT] = run_ip
+        self.idle = False
+
+    # Gives the (atom, content) of the message from the mailbox that was
+    # handled instead of going idle, if any
+    def go_idle(self):
+        msg = self.mailbox.take_matching(self.handlers)
+        if msg is None:
+            self.idle = True
+        else:
+            self.handle_message(*msg)
+        return msg
+
+    def state(self):
+        if self.idle:
+            return "idle"
+        if self.fault is not None or self.decoder.decode(self.regfile[IP_SLOT]) is None:
+            return "blocked"
+        return "runnable"
+
     def query_instructions(self):
-        code_after_ip = self.code_ref[self.registers["ip"]:]
-        CPU_LOG.debug(f"Parsing instruction {code_after_ip}")
-        inst_init = parse_instruction(code_after_ip)
-        if inst_init == None:
+        if self.idle or self.fault is not None:
             return []
+
+        ip = self.regfile[IP_SLOT]
+        CPU_LOG.debug(f"Parsing instruction at {hex(ip)}")
+        decoded = self.decoder.decode(ip)
+        if decoded == None:
+            return []
+        inst_init, length = decoded
         inst = inst_init(self.address)
+        inst.ip = ip
+        inst.length = length
         return [inst]
 
     def __str__(self):
         return f"CPU(addr={hex(self.address)}, registers={self.registers}, ram={self.ram}, handlers={self.handlers})"
 
 class VirtualMachine:
-    def __init__(self, code):
+    # inherit_ram: new actors start with a copy-on-write snapshot of their
+    # creator's RAM instead of empty RAM
+    # policy: how the scheduler picks cores, see scheduler.POLICIES
+    # boot: start with a core at $ip=0. Without it, cores only come from new_actor
+    # seed: for the random address of the first core, journaled so it can be replayed
+    def __init__(self, code, predecode=False, inherit_ram=False, policy="round-robin", boot=True, seed=None):
         VM_LOG.info("Made a virtual machine!")
         self.code = code
-
-        self.cores = [CPU(random.getrandbits(64), 0, self.code)]
-
-    def query_instructions(self):
+        self.inherit_ram = inherit_ram
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.rng = random.Random(self.seed)
+        self.decoder = DecodeCache(self.code)
+        if predecode:
+            self.decoder.predecode()
+
+        self.cores = CoreRegistry()
+        self.scheduler = Scheduler(policy)
+        self.deferred_changes = None # [CPU] while a BatchExecutor runs actions concurrently
+        self.deltas = None # DeltaBuffer, when somebody wants to know what actions changed
+        self.journal = None # Journal, when completed instructions should be written down
+        if boot:
+            self.add_core(CPU(self.rng.getrandbits(64), 0, self.code, self.decoder))
+
+    # Gives the instructions of the runnable cores, or of at most limit of them
+    def query_instructions(self, limit=None):
         VM_LOG.info("querying instructions")
         instructions = []
-        for core in self.cores:
-            instructions.extend(core.query_instructions())
+        for core in self.scheduler.pick(limit):
+            core_instructions = core.query_instructions()
+            if not core_instructions:
+                # Something changed the core behind the scheduler's back
+                self.scheduler.update(core)
+            instructions.extend(core_instructions)
         return instructions
 
+    def add_core(self, core):
+        self.cores.add(core)
+        self.scheduler.add(core)
+
+    # Has to be called after changing a core in a way that might make it
+    # runnable, idle or blocked
+    def core_changed(self, core):
+        if self.deferred_changes is not None:
+            self.deferred_changes.append(core)
+        elif core.address in self.cores:
+            self.scheduler.update(core)
+        else:
+            # Removed while the scheduler's updates were deferred
+            self.scheduler.remove(core.address)
+
+    # Runs the action answering inst (from query_instructions), then moves $ip
+    # of the core on to the next instruction, unless the action already moved it
+    def complete_instruction(self, inst, act):
+        self.complete(inst.req_addr, inst.ip, inst.length, act)
+
+    # complete_instruction, for the instruction of length at ip in req_addr
+    def complete(self, req_addr, ip, length, act):
+        if self.journal is not None:
+            self.journal.completed(req_addr, ip, length, act)
+
+        act.run(self)
+
+        core = self.cores.get(req_addr)
+        if core is not None and core.regfile[IP_SLOT] == ip:
+            core.regfile[IP_SLOT] = ip + length
+            if self.deltas is not None:
+                self.deltas.regs(core, ["ip"])
+            self.core_changed(core)
+
+    # Running the instruction at $ip of core raised error. The core is
+    # blocked from then on, so that the other cores keep running
+    def fault(self, core, error):
+        VM_LOG.warn(f"{hex(core.address)} faulted at $ip={hex(core.regfile[IP_SLOT])}: {error!r}")
+        core.fault = error
+        self.core_changed(core)
+
     def get_core_with_addr(self, addr, default_on_not_found=True):
-        for core in self.cores:
-            if core.address == addr:
-                return core
+        core = self.cores.get(addr)
+        if core is not None:
+            return core
 
         if default_on_not_found:
             VM_LOG.warn(f"Tried to access CPU at address {hex(addr)}, but found nothing!")
-            return CPU(-1, -1, self.code)
+            return CPU(-1, -1, self.code, self.decoder)
 
     def print_message(self, msg):
         print("[OUTPUT]:", msg)
 
-    def new_actor(self, addr, ip):
-        if self.get_core_with_addr(addr, default_on_not_found=False) is not None:
+    # Gives the new CPU, or None if there already is one at addr
+    def new_actor(self, addr, ip, creator_addr=None):
+        if addr in self.cores:
             print("[TRIED TO REGISTER A NEW ACTOR WITH AN ALREADY EXISTING ADDRESS")
+            return None
+
+        core = CPU(addr, ip, self.code, self.decoder)
+
+        if creator_addr is not None:
+            core.registers["ra"] = creator_addr
+
+            creator = self.cores.get(creator_addr)
+            if self.inherit_ram and creator is not None:
+                core.ram = creator.ram.snapshot()
+
+        self.add_core(core)
+        return core
+
+    def remove_actor(self, addr):
+        core = self.cores.remove(addr)
+        if core is None:
+            VM_LOG.warn(f"Tried to remove CPU at address {hex(addr)}, but found nothing!")
             return
 
-        self.cores.append(CPU(addr, ip, self.code))
+        if self.deferred_changes is not None:
+            self.deferred_changes.append(core)
+        else:
+            self.scheduler.remove(addr)
+        if self.deltas is not None:
+            self.deltas.removed(addr)